@@ -1,21 +1,28 @@
-import string
+import io
 
-import cv2
-import numpy as np
 from flask import Flask, jsonify, request
 from PIL import Image
 
-from board_builder import BoardBuilderException, build_board, clean_solution
-from solver import full_solve
+from board_builder import (
+    BoardBuilderException,
+    build_board,
+    build_boards,
+    clean_solution,
+    decode_image,
+    image_size,
+)
+from bitboard import compile_board
+from configs import SOLVE_ALL_DEADLINE
+from model_registry import preload
+from persistence import save_picture
+from solution_cache import get_solution, set_solution, solution_key
+from solver import SOLVERS, new_stats, report, solve_all_goals
+from stream import close_session, read_frame, start_session
 
 app = Flask(__name__)
 
-
-def random_string(y):
-    """
-    Generate a random string of given length
-    """
-    return "".join(np.random.choice(list(string.ascii_letters), y, replace=True))
+# load models at import, so gunicorn --preload shares them between workers
+preload()
 
 
 @app.route("/im_size", methods=["POST"])
@@ -23,15 +30,16 @@ def process_image():
     file = request.files["image"]
     img = Image.open(file.stream)
 
-    return jsonify({"msg": "success", "size": [img.width, img.height]})
+    return jsonify({"msg": "success", "size": image_size(img)})
 
 
 @app.route("/read", methods=["POST"])
 def read_board():
     file = request.files["file"]
-    img = np.array(Image.open(file.stream))[:, :, ::-1]
-
-    cv2.imwrite(f"./pictures/{random_string(6)}.png", img)
+    data = file.read()
+    pil_img = Image.open(io.BytesIO(data))
+    save_picture(data, f".{pil_img.format.lower()}")
+    img = decode_image(pil_img)
 
     # img = cv2.imread("./data/input/20240415_102619.jpg")
 
@@ -42,17 +50,86 @@ def read_board():
     return jsonify({"msg": "success", "board": board})
 
 
+@app.route("/read_batch", methods=["POST"])
+def read_boards():
+    files = request.files.getlist("files")
+    imgs = [decode_image(Image.open(file.stream)) for file in files]
+
+    results = []
+    for board in build_boards(imgs):
+        if isinstance(board, BoardBuilderException):
+            results.append({"msg": "error", "error": str(board)})
+        else:
+            results.append({"msg": "success", "board": board})
+    return jsonify({"msg": "success", "results": results})
+
+
+@app.route("/stream", methods=["POST"])
+def open_stream():
+    return jsonify({"msg": "success", "session": start_session()})
+
+
+@app.route("/stream/<session_id>/frame", methods=["POST"])
+def read_stream_frame(session_id):
+    file = request.files["file"]
+    img = decode_image(Image.open(file.stream))
+
+    try:
+        board, tracked = read_frame(session_id, img)
+    except BoardBuilderException as e:
+        return jsonify({"msg": "error", "error": str(e)})
+    return jsonify({"msg": "success", "board": board, "tracked": tracked})
+
+
+@app.route("/stream/<session_id>", methods=["DELETE"])
+def close_stream(session_id):
+    close_session(session_id)
+    return jsonify({"msg": "success"})
+
+
 @app.route("/solve", methods=["POST"])
 def solve():
     data = request.get_json()
     board = data["board"]
     goal = tuple(data["goal"])
     robot = data["robot"]
+    solver = data.get("solver", "full")
+    if solver not in SOLVERS:
+        return jsonify({"msg": "error", "error": f"Unknown solver {solver}"})
+    stats = new_stats(deadline=data.get("deadline"), max_nodes=data.get("max_nodes"))
     state = {"robots": board["robots"], "cost": 0, "prev_state": None}
-    winning_state = full_solve(board["walls"], state, robot, goal)
-    board, moves = clean_solution(board, winning_state)
+    key, turns = solution_key(board["walls"], board["robots"], robot, goal, solver)
+    path = get_solution(key, turns)
+    if path is None:
+        path = SOLVERS[solver](compile_board(board), state, robot, goal, stats=stats)
+        # a path found once the budget ran out may not be the best one
+        if path is not None and stats["status"] == "running":
+            set_solution(key, turns, path)
+    stats = report(stats, path)
+    if path is None:
+        return jsonify({"msg": "unsolved", "board": board, "stats": stats})
+    board, moves = clean_solution(board, path)
     print(board["robots"])
-    return jsonify({"msg": "success", "board": board, "moves": moves})
+    return jsonify({"msg": "success", "board": board, "moves": moves, "stats": stats})
+
+
+@app.route("/solve_all", methods=["POST"])
+def solve_all():
+    data = request.get_json()
+    board = data["board"]
+    stats = new_stats(
+        deadline=data.get("deadline", SOLVE_ALL_DEADLINE), max_nodes=data.get("max_nodes")
+    )
+    state = {"robots": board["robots"], "cost": 0, "prev_state": None}
+    paths = solve_all_goals(compile_board(board), state, board.get("goals", {}), stats=stats)
+    solutions = {}
+    for name, path in paths.items():
+        _, moves = clean_solution(board, path)
+        solutions[name] = moves
+    if all(paths.values()):
+        stats["status"] = "solved"
+    stats = report(stats, None)
+    return jsonify({"msg": "success", "board": board, "solutions": solutions, "stats": stats})
 
 
 if __name__ == "__main__":
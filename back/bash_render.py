@@ -1,14 +1,13 @@
+from bitboard import column_walls, get_masks, row_walls
 from configs import BOARD_SIZE
+from solver import path_robots
 
 
-def print_path(walls, state, robot_name, goal=None):
+def print_path(walls, path, robot_name, goal=None):
     """Display all the states along the path we took"""
-    count = 0
-    while state is not None:
-        print_board(state["robots"], walls, goal)
-        state = state["prev_state"]
-        count += 1
-    print("number of moves: {}".format(count))
+    for robots in path_robots(path):
+        print_board(robots, walls, goal)
+    print("number of moves: {}".format(path["cost"]))
 
 
 def render_item(name):
@@ -100,17 +99,18 @@ def print_board(robots, walls, goal=None):
     There is a 'location' every 0.5 spacing.
     Each 'location' is rendered with two chars.
     robots: dictionary of name: (x,y)
-    walls: list of (x,y) tuples
+    walls: list of (x,y) tuples, or compiled board
     goal: optional (x,y)"""
     board = get_empty_board(BOARD_SIZE)
 
     # add walls
-    for x, y in walls:
-        if x != int(x):  # change render based on whether x or y is between ints
-            wall = " │"
-        else:
-            wall = "——"
-        board[int(y * 2)][int(x * 2)] = wall
+    masks = get_masks(walls)
+    for square in row_walls(masks):
+        x, y = divmod(square, BOARD_SIZE)
+        board[y * 2][x * 2 + 1] = " │"
+    for square in column_walls(masks):
+        x, y = divmod(square, BOARD_SIZE)
+        board[y * 2 + 1][x * 2] = "——"
 
     # add goal
     if goal is not None:
@@ -0,0 +1,150 @@
+import argparse
+import contextlib
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from board_builder import board_layouts, make_board
+from configs import BOARD_SIZE
+from solver import GOAL_ROBOTS, SOLVERS, new_stats, report
+
+ROBOTS = ["red", "green", "blue", "yellow"]
+CENTER = [(7, 7), (7, 8), (8, 7), (8, 8)]
+
+
+def get_cases(n_boards=None, seed=0):
+    """
+    Generate a reproducible corpus of (board, robots, goal) cases.
+    Boards are taken from every physical layout, robots are placed at random
+    n_boards: number of layouts to sample, all of them if None
+    """
+    rng = random.Random(seed)
+    layouts = board_layouts()
+    if n_boards is not None:
+        layouts = rng.sample(layouts, n_boards)
+    squares = [
+        (x, y) for x in range(BOARD_SIZE) for y in range(BOARD_SIZE) if (x, y) not in CENTER
+    ]
+    cases = []
+    for qlabels in layouts:
+        board = make_board(qlabels)
+        robots = dict(zip(ROBOTS, rng.sample(squares, len(ROBOTS))))
+        for name, goal in board["goals"].items():
+            cases.append({
+                "layout": qlabels,
+                "walls": board["walls"],
+                "robots": robots,
+                "goal_name": name,
+                "goal": tuple(goal),
+                "robot": GOAL_ROBOTS.get(name[0], rng.choice(ROBOTS)),
+            })
+    return cases
+
+
+def solve(case, mode, stats):
+    """
+    Run a solver on a case, silencing its logs
+    """
+    state = {"robots": case["robots"], "cost": 0, "prev_state": None}
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return SOLVERS[mode](case["walls"], state, case["robot"], case["goal"], stats=stats)
+
+
+def run_case(case, mode, deadline=None, max_nodes=None, memory=True):
+    """
+    Solve one case with the given solver, and measure it.
+    Memory is traced in a second run limited to the same number of nodes,
+    since tracing slows the solvers down
+    """
+    stats = new_stats(deadline=deadline, max_nodes=max_nodes)
+    t0 = time.perf_counter()
+    path = solve(case, mode, stats)
+    duration = time.perf_counter() - t0
+    stats = report(stats, path)
+
+    peak = None
+    if memory:
+        tracemalloc.start()
+        solve(case, mode, new_stats(max_nodes=stats["nodes"]))
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "layout": case["layout"],
+        "robots": case["robots"],
+        "goal": case["goal_name"],
+        "robot": case["robot"],
+        "mode": mode,
+        "status": stats["status"],
+        "moves": stats.get("cost"),
+        "nodes": stats["nodes"],
+        "time": duration,
+        "nodes_per_sec": stats["nodes"] / duration if duration > 0 else None,
+        "peak_memory": peak,
+    }
+
+
+def summarize(results):
+    """
+    Aggregate results per solver mode
+    """
+    summary = {}
+    for result in results:
+        mode = summary.setdefault(
+            result["mode"],
+            {"cases": 0, "solved": 0, "moves": 0, "nodes": 0, "time": 0.0, "peak_memory": 0},
+        )
+        mode["cases"] += 1
+        mode["nodes"] += result["nodes"]
+        mode["time"] += result["time"]
+        mode["peak_memory"] = max(mode["peak_memory"], result["peak_memory"] or 0)
+        if result["moves"] is not None:
+            mode["solved"] += 1
+            mode["moves"] += result["moves"]
+    for mode in summary.values():
+        mode["nodes_per_sec"] = mode["nodes"] / mode["time"] if mode["time"] > 0 else None
+    return summary
+
+
+def main():
+    """
+    Run the solver benchmark, write one JSON line per (case, mode) and a final summary line
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the solver modes")
+    parser.add_argument(
+        "--modes",
+        nargs="+",
+        default=["astar", "optimal", "bidirectional", "full"],
+        choices=list(SOLVERS),
+    )
+    parser.add_argument("--boards", type=int, default=10, help="number of layouts, 0 for all of them")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--deadline", type=float, default=10.0, help="max seconds per case")
+    parser.add_argument("--max-nodes", type=int, default=None, help="max expanded states per case")
+    parser.add_argument("--no-memory", action="store_true", help="skip peak memory measurement")
+    parser.add_argument("--output", default="-", help="JSON lines output file, - for stdout")
+    args = parser.parse_args()
+
+    cases = get_cases(n_boards=args.boards or None, seed=args.seed)
+    out = sys.stdout if args.output == "-" else open(args.output, "w")
+    results = []
+    for case in cases:
+        for mode in args.modes:
+            result = run_case(
+                case,
+                mode,
+                deadline=args.deadline,
+                max_nodes=args.max_nodes,
+                memory=not args.no_memory,
+            )
+            results.append(result)
+            print(json.dumps(result), file=out, flush=True)
+    summary = {"summary": summarize(results), "seed": args.seed, "cases": len(cases)}
+    print(json.dumps(summary), file=out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+import math
+
+from configs import BOARD_SIZE
+
+# Directions, in the same order as get_robot_moves results
+UP, DOWN, RIGHT, LEFT = range(4)
+
+# Squares that are not in the last column
+NOT_LAST_COLUMN = sum(
+    1 << (x * BOARD_SIZE + y) for x in range(BOARD_SIZE) for y in range(BOARD_SIZE - 1)
+)
+
+# Compiled board
+# dict(masks=[up, down, right, left], goals=dict(name=square), robots=dict(name=square))
+# masks are BOARD_SIZE**2 bit integers, bit `square` is set when a wall stops a robot
+# on that square from moving in the direction. Squares are x * BOARD_SIZE + y indices.
+
+
+def to_square(coords):
+    """Converts (x, y) coords to a square index in [0, BOARD_SIZE**2)"""
+    x, y = coords
+    return int(x) * BOARD_SIZE + int(y)
+
+
+def to_coords(square):
+    """Converts a square index back to (x, y) coords"""
+    return divmod(square, BOARD_SIZE)
+
+
+def squares_of(mask):
+    """Iterates over the squares set in a mask"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+def wall_masks(walls):
+    """Compiles a list of (x, y) walls, one coord being a half integer, to direction masks"""
+    masks = [0, 0, 0, 0]
+
+    def block(direction, x, y):
+        if 0 <= x < BOARD_SIZE and 0 <= y < BOARD_SIZE:
+            masks[direction] |= 1 << (x * BOARD_SIZE + y)
+
+    for x, y in walls:
+        if x != int(x):  # wall between two rows
+            block(RIGHT, math.floor(x), int(y))
+            block(LEFT, math.ceil(x), int(y))
+        else:  # wall between two columns
+            block(UP, int(x), math.floor(y))
+            block(DOWN, int(x), math.ceil(y))
+    return masks
+
+
+def row_walls(masks):
+    """Squares with a wall between them and the next row, ie on their right"""
+    return squares_of(masks[RIGHT] | masks[LEFT] >> BOARD_SIZE)
+
+
+def column_walls(masks):
+    """Squares with a wall between them and the next column, ie above them"""
+    return squares_of(masks[UP] | masks[DOWN] >> 1 & NOT_LAST_COLUMN)
+
+
+def mask_walls(masks):
+    """Turns direction masks back into a list of (x, y) walls"""
+    walls = []
+    for square in row_walls(masks):
+        x, y = divmod(square, BOARD_SIZE)
+        walls.append((x + 0.5, y))
+    for square in squares_of(masks[LEFT] & (1 << BOARD_SIZE) - 1):  # walls before row 0
+        walls.append((-0.5, square))
+    for square in column_walls(masks):
+        x, y = divmod(square, BOARD_SIZE)
+        walls.append((x, y + 0.5))
+    for x in range(BOARD_SIZE):  # walls before column 0
+        if masks[DOWN] >> (x * BOARD_SIZE) & 1:
+            walls.append((x, -0.5))
+    return walls
+
+
+def get_masks(walls):
+    """Direction masks of a compiled board, or of a list of walls"""
+    if isinstance(walls, dict):
+        return walls["masks"]
+    return wall_masks(walls)
+
+
+def compile_board(board):
+    """Compiles a board as exchanged by the API, ie dict(walls, goals, robots)
+    with (x, y) coords, goals and robots being optional"""
+    return {
+        "masks": wall_masks(board["walls"]),
+        "goals": {name: to_square(xy) for name, xy in board.get("goals", {}).items()},
+        "robots": {name: to_square(xy) for name, xy in board.get("robots", {}).items()},
+    }
+
+
+def board_json(compiled):
+    """Turns a compiled board back into the board exchanged by the API"""
+    board = {
+        "walls": [[x, y] for x, y in mask_walls(compiled["masks"])],
+        "goals": {name: to_coords(square) for name, square in compiled["goals"].items()},
+    }
+    if compiled["robots"]:
+        board["robots"] = {name: to_coords(square) for name, square in compiled["robots"].items()}
+    return board
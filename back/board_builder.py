@@ -1,11 +1,19 @@
+import itertools
 import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
+from PIL import ImageOps
+from scipy.optimize import linear_sum_assignment
 
+from bitboard import board_json, compile_board
 from chunk_classifier import predict_chunks
-from configs import CHUNK_SIZE, IMG_SIZE, QUARTERS
+from configs import CHUNK_SIZE, IMG_SIZE, PROXY_SIZE, QUARTERS, ROBOT_CANDIDATES
+from move_tables import get_move_tables
 from robot_classifier import predict_robots
+from solver import path_robots
 
 
 class BoardBuilderException(Exception):
@@ -16,6 +24,12 @@ class NotEnoughLinesException(BoardBuilderException):
     pass
 
 
+# Width of the board frame in a projected IMG_SIZE image, removed by crop_square
+BORDER = 12
+# Min grey level drop between the playing area and the frame, along a board edge
+MIN_EDGE_DROP = 20
+
+
 def image_resize(img, height=1024):
     """
     Resize image to same normalized area (height**2)
@@ -29,6 +43,27 @@ def image_resize(img, height=1024):
     return img
 
 
+def decode_image(img, height=IMG_SIZE):
+    """
+    Decode an opened PIL image to a BGR array of about height**2 pixels or more,
+    in the orientation given by its EXIF tags.
+    JPEG images are decoded straight at a reduced scale, instead of decoding every pixel
+    """
+    scale = min(1.0, height / math.sqrt(img.width * img.height))
+    img.draft("RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    return np.asarray(img)[:, :, ::-1]
+
+
+def image_size(img):
+    """
+    Size of an opened PIL image once oriented by its EXIF tags, read from the headers only
+    """
+    if img.getexif().get(0x0112) in (5, 6, 7, 8):  # rotated by 90 or 270 degrees
+        return [img.height, img.width]
+    return [img.width, img.height]
+
+
 def get_intersect(a1, a2, b1, b2):
     """
     Return the point of intersection of the lines passing through a2,a1 and b2,b1
@@ -43,24 +78,36 @@ def get_intersect(a1, a2, b1, b2):
     return (x / z, y / z)
 
 
-def get_lines(img):
+def auto_canny(grey_img, sigma=0.75):
+    """
+    Canny edges with thresholds around the median intensity of the image
+    """
+    v = np.median(grey_img)
+    lower = int(max(0, (1.0 - sigma) * v))
+    upper = int(min(255, (1.0 + sigma) * v))
+    return cv2.Canny(grey_img, lower, upper)
+
+
+def get_lines(img, scale=1.0):
     """
     Get all lines from image using Canny and Hough transform
+    scale: size of img relative to IMG_SIZE, Hough lengths are scaled accordingly
     """
     # Preprocess
     grey_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     grey_img = cv2.blur(grey_img, (3, 3))
 
     # Canny
-    sigma = 0.75
-    v = np.median(grey_img)
-    lower = int(max(0, (1.0 - sigma) * v))
-    upper = int(min(255, (1.0 + sigma) * v))
-    edges = cv2.Canny(grey_img, lower, upper)
+    edges = auto_canny(grey_img)
 
     # Hough
     lines = cv2.HoughLinesP(
-        edges, 1, np.pi / 180, 100, minLineLength=200, maxLineGap=50
+        edges,
+        1,
+        np.pi / 180,
+        int(100 * scale),
+        minLineLength=200 * scale,
+        maxLineGap=50 * scale,
     )
     if lines is None:
         return np.array([])
@@ -91,20 +138,28 @@ def classify_lines(lines):
     return h_lines, v_lines
 
 
-def get_corners(img, h_lines, v_lines):
+def get_edge_candidates(h_lines, v_lines):
     """
-    Get 4 corners of the board in the image
-    using the intersection of the min and max horizontal and vertical lines
+    Candidate lines of the 4 board edges, from the outermost one:
+    top and bottom horizontal lines, left and right vertical lines
     """
     sorted_v_lines = sorted(v_lines, key=lambda x: x[0] + x[2])
     sorted_h_lines = sorted(h_lines, key=lambda x: x[1] + x[3])
+    return sorted_h_lines, sorted_h_lines[::-1], sorted_v_lines, sorted_v_lines[::-1]
 
-    h_top = sorted_h_lines[0]
-    h_bot = sorted_h_lines[-1]
-    v_left = sorted_v_lines[0]
-    v_right = sorted_v_lines[-1]
 
-    corners = np.array(
+def get_edges(h_lines, v_lines):
+    """
+    Get the 4 board edges: top and bottom horizontal lines, left and right vertical lines
+    """
+    return [candidates[0] for candidates in get_edge_candidates(h_lines, v_lines)]
+
+
+def line_corners(h_top, h_bot, v_left, v_right):
+    """
+    Intersections of the 4 edges: top left, top right, bottom left and bottom right corners
+    """
+    return np.array(
         [
             get_intersect(h_top[:2], h_top[2:], v_left[:2], v_left[2:]),
             get_intersect(h_top[:2], h_top[2:], v_right[:2], v_right[2:]),
@@ -112,12 +167,119 @@ def get_corners(img, h_lines, v_lines):
             get_intersect(h_bot[:2], h_bot[2:], v_right[:2], v_right[2:]),
         ]
     )
-    return corners
 
 
-def warp_image(img, corners):
+def get_corners(img, h_lines, v_lines):
     """
-    Reproject image to a square using corners coords
+    Get 4 corners of the board in the image
+    using the intersection of the min and max horizontal and vertical lines
+    """
+    return line_corners(*get_edges(h_lines, v_lines))
+
+
+def fit_edge(grey_img, a, b, center, band, segments=8, samples=16):
+    """
+    Fit the edge of the playing area along the board side going from corner a to b.
+    The light playing area meets the darker frame on a sharp edge, unlike the frame and
+    the table. Grey levels are averaged over segments of the side, for each offset up to
+    band pixels across it, and the edge is the strongest outward drop of each segment.
+    center: a point inside the board
+    returns: the fitted line, and the median drop of the segments
+    """
+    length = np.linalg.norm(b - a)
+    direction = (b - a) / length
+    normal = np.array([-direction[1], direction[0]])
+    if normal @ (a - center) < 0:
+        normal = -normal
+    # positions along the side, away from the corners
+    ts = np.linspace(0.1, 0.9, segments * samples).reshape((segments, samples)) * length
+    offsets = np.arange(-band, band + 1)
+    points = a + ts[:, :, None, None] * direction + offsets[:, None] * normal
+    points = points.reshape((segments * samples, len(offsets), 2)).astype(np.float32)
+    values = cv2.remap(
+        grey_img, points[..., 0], points[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE
+    )
+    profiles = values.reshape((segments, samples, -1)).mean(axis=1)
+    drops = profiles[:, :-1] - profiles[:, 1:]
+
+    rows = np.arange(segments)
+    k = np.clip(drops.argmax(axis=1), 1, drops.shape[1] - 2)
+    # subpixel position of the drop, from a parabola through its neighbours
+    left, peak, right = drops[rows, k - 1], drops[rows, k], drops[rows, k + 1]
+    curvature = left - 2 * peak + right
+    shift = np.where(curvature < 0, 0.5 * (left - right) / np.minimum(curvature, -1e-6), 0)
+    edge = a + ts.mean(axis=1)[:, None] * direction + (offsets[k] + 0.5 + shift)[:, None] * normal
+    vx, vy, cx, cy = cv2.fitLine(edge.astype(np.float32), cv2.DIST_HUBER, 0, 0.01, 0.01).ravel()
+    return np.array([cx, cy, cx + vx, cy + vy]), np.median(peak)
+
+
+def fit_playing_area(grey_img, edges, bands=(24, 6)):
+    """
+    Fit the 4 edges of the playing area around approximate board edges, the first band
+    covering the error of lines found on a downscaled image
+    edges: top, bottom, left and right lines
+    returns: the 4 corners of the playing area, and the drop found on each edge
+    """
+    drops = None
+    for band in bands:
+        corners = line_corners(*edges)
+        center = corners.mean(axis=0)
+        fits = [
+            fit_edge(grey_img, corners[i], corners[j], center, band)
+            for i, j in [(0, 1), (2, 3), (0, 2), (1, 3)]
+        ]
+        edges = [line for line, _ in fits]
+        if drops is None:
+            drops = [drop for _, drop in fits]
+    return line_corners(*edges), drops
+
+
+def frame_corners(corners):
+    """
+    Corners of the whole board from the corners of its playing area,
+    the frame being BORDER pixels wide once projected
+    """
+    square = np.float32([[0, 0], [IMG_SIZE, 0], [0, IMG_SIZE], [IMG_SIZE, IMG_SIZE]])
+    inner = np.float32([[BORDER, BORDER], [-BORDER, BORDER], [BORDER, -BORDER], [-BORDER, -BORDER]])
+    h = cv2.getPerspectiveTransform(square + inner, corners.astype(np.float32))
+    return cv2.perspectiveTransform(square.reshape((-1, 1, 2)), h).reshape((-1, 2))
+
+
+def find_corners(img, proxy_size=None):
+    """
+    Get 4 corners of the board in an IMG_SIZE image.
+    Board edges are first found with Hough lines, then the playing area is fitted
+    at full resolution around them. Edges whose playing area drop is too weak, eg.
+    lines of the table, are replaced by the next line inwards
+    proxy_size: if set, lines are detected on a downscaled copy of this size
+    """
+    if proxy_size is None:
+        proxy, scale = img, 1.0
+    else:
+        proxy = image_resize(img, height=proxy_size)
+        scale = img.shape[0] / proxy.shape[0]
+
+    lines = get_lines(proxy, scale=1 / scale)
+    if len(lines) == 0:
+        raise NotEnoughLinesException("No lines found")
+    candidates = get_edge_candidates(*classify_lines(lines * scale))
+    grey_img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    choice = [0, 0, 0, 0]
+    while True:
+        if any(i >= len(lines) for i, lines in zip(choice, candidates)):
+            raise NotEnoughLinesException("No board edge found")
+        edges = [lines[i] for i, lines in zip(choice, candidates)]
+        corners, drops = fit_playing_area(grey_img, edges)
+        weak = [side for side, drop in enumerate(drops) if drop < MIN_EDGE_DROP]
+        if not weak:
+            return frame_corners(corners)
+        for side in weak:
+            choice[side] += 1
+
+
+def get_homography(corners):
+    """
+    Homography from the board corners to a IMG_SIZExIMG_SIZE square
     """
     h, _ = cv2.findHomography(
         corners,
@@ -125,34 +287,55 @@ def warp_image(img, corners):
         cv2.RANSAC,
         5.0,
     )
+    return h
+
+
+def warp_image(img, corners):
+    """
+    Reproject image to a square using corners coords
+    """
+    h = get_homography(corners)
     projected = cv2.warpPerspective(img.copy(), h, (IMG_SIZE, IMG_SIZE))
     return projected
 
 
-def resample(mat, N):
+def chunk_grid(mat, N):
     """
-    Resample mat to NxN chunks
+    View mat as a grid of NxN chunks, without copying
+    returns: array of shape (rows, cols, N, N, ...)
     """
-    A = []
-    for v in np.vsplit(mat, mat.shape[0] // N):
-        A.extend([*np.hsplit(v, mat.shape[0] // N)])
-    return np.array(A)
+    rows, cols = mat.shape[0] // N, mat.shape[1] // N
+    return mat.reshape((rows, N, cols, N) + mat.shape[2:]).swapaxes(1, 2)
 
 
-def get_square(img):
+def chunk_list(mat, N):
+    """
+    Flatten the grid of NxN chunks of mat to a (rows * cols, N, N, ...) array
+    """
+    grid = chunk_grid(mat, N)
+    return grid.reshape((-1,) + grid.shape[2:])
+
+
+def get_square(img, proxy_size=PROXY_SIZE):
     """
     Return board image cropped and projected to a IMG_SIZExIMG_SIZE img
+    proxy_size: size of the image used for line detection, full size if None
     """
     img = image_resize(img, height=IMG_SIZE)
-    lines = get_lines(img)
-    if len(lines) == 0:
-        raise NotEnoughLinesException("No lines found")
-    h_lines, v_lines = classify_lines(lines)
-    corners = get_corners(img, h_lines, v_lines)
-    projected = warp_image(img, corners)
-    # Remove 12 pixels of border
-    border = 12
-    cropped = projected[border:-border, border:-border, :]
+    corners = find_corners(img, proxy_size)
+    return crop_square(img, corners)
+
+
+def crop_square(img, corners, homography=None):
+    """
+    Project an IMG_SIZE image to the board square given its corners, and remove its border
+    homography: precomputed homography for these corners, if any
+    """
+    if homography is None:
+        projected = warp_image(img, corners)
+    else:
+        projected = cv2.warpPerspective(img, homography, (IMG_SIZE, IMG_SIZE))
+    cropped = projected[BORDER:-BORDER, BORDER:-BORDER, :]
     cropped = image_resize(cropped, height=IMG_SIZE)
     return cropped
 
@@ -195,7 +378,7 @@ def get_quarters(proba):
     """
     Detect four quarters of the board from the prediction
     """
-    quarters = resample(proba, 8)
+    quarters = chunk_list(proba, 8)
     qlabels = []
     rot = [0, 1, 3, 2]
     for i, quarter in enumerate(quarters):
@@ -203,12 +386,60 @@ def get_quarters(proba):
     return qlabels
 
 
+def board_layouts():
+    """
+    List all the physical boards, as quarter labels.
+    Each of the 4 double sided tiles is used once, on either side
+    """
+    tiles = [(0, 1), (2, 3), (4, 5), (6, 7)]
+    layouts = []
+    for order in itertools.permutations(tiles):
+        for sides in itertools.product([0, 1], repeat=len(tiles)):
+            layouts.append([tile[side] for tile, side in zip(order, sides)])
+    return layouts
+
+
 def get_board_bg(proba):
     """
-    Get the board background (ie walls+goals) from the prediction
+    Get the compiled board background (ie walls+goals) from the prediction
+    """
+    return compile_layout(get_quarters(proba))
+
+
+# quarter labels -> compiled board background, there are only 8**4 of them so it is never evicted
+_boards = {}
+_boards_lock = threading.Lock()
+
+
+def compile_layout(qlabels):
+    """
+    Get the compiled board background (see bitboard) from the 4 quarter labels.
+    Backgrounds are compiled once per layout, along with their solver move tables,
+    and shared: they must not be modified
+    """
+    key = tuple(qlabels)
+    with _boards_lock:
+        board = _boards.get(key)
+    if board is None:
+        board = compile_board(build_board_bg(key))
+        get_move_tables(board)
+        with _boards_lock:
+            board = _boards.setdefault(key, board)
+    return board
+
+
+def make_board(qlabels):
+    """
+    Get the board background (ie walls+goals) from the 4 quarter labels
+    """
+    return board_json(compile_layout(qlabels))
+
+
+def build_board_bg(qlabels):
+    """
+    Build the board background (ie walls+goals) from the 4 quarter labels
     """
     rot = [0, 1, 3, 2]
-    qlabels = get_quarters(proba)
     board = {"walls": np.empty((0, 2)), "goals": {}}
     for i, qlabel in enumerate(qlabels):
         quarter = QUARTERS[qlabel]
@@ -223,52 +454,119 @@ def get_board_bg(proba):
     return board
 
 
+def get_robot_candidates(proba, k=ROBOT_CANDIDATES, nms=False):
+    """
+    Get the coords of the k chunks most likely to hold a robot, from the "robot" probability
+    nms: keep only chunks that are a local maximum of their 3x3 neighbourhood
+    """
+    if nms:
+        rows, cols = proba.shape
+        padded = np.pad(proba, 1, constant_values=-np.inf)
+        neighbours = np.max(
+            [
+                padded[1 + dx : 1 + dx + rows, 1 + dy : 1 + dy + cols]
+                for dx in (-1, 0, 1)
+                for dy in (-1, 0, 1)
+            ],
+            axis=0,
+        )
+        proba = np.where(proba >= neighbours, proba, -np.inf)
+    order = np.argsort(proba, axis=None)[::-1][:k]
+    order = order[np.isfinite(proba.ravel()[order])]
+    return np.stack(np.unravel_index(order, proba.shape), axis=1)
+
+
+def assign_robots(coords, proba, robot_proba):
+    """
+    Give a color to the most likely robot candidates,
+    maximizing the joint likelihood of all the robots at once
+    """
+    labels = ["yellow", "red", "green", "blue"]
+    eps = 1e-9
+    likelihood = np.log(proba[coords[:, 0], coords[:, 1]] + eps)[:, None]
+    likelihood = likelihood + np.log(robot_proba + eps)
+    chunks, colors = linear_sum_assignment(likelihood, maximize=True)
+    return {labels[color]: coords[chunk].tolist() for chunk, color in zip(chunks, colors)}
+
+
 def get_robots(chunks, proba):
     """
     Get the robots positions from the prediction
     """
-    labels = ["yellow", "red", "green", "blue"]
-    threshold = 0.0
-    coords = np.argwhere(proba >= threshold)
+    coords = get_robot_candidates(proba)
     robot_proba = predict_robots(chunks[coords[:, 0], coords[:, 1]])
-    order = np.argsort(proba[proba >= threshold])[::-1]
-    robots = {}
-    for idx in order:
-        if len(robots) == 4:
-            break
-        robot = labels[np.argmax(robot_proba[idx])]
-        if robot not in robots:
-            robots[robot] = coords[idx].tolist()
-    return robots
+    return assign_robots(coords, proba, robot_proba)
+
+
+def read_square(projected):
+    """
+    Classify the chunks of a projected board image
+    returns: the quarter labels and the robots
+    """
+    grid = chunk_grid(projected, CHUNK_SIZE)
+    proba = predict_chunks(grid.reshape((-1,) + grid.shape[2:])).reshape((16, 16, 4))
+    return get_quarters(proba), get_robots(grid, proba[:, :, 3])
 
 
 def build_board(img):
-    projected = get_square(img)
-    chunks = resample(projected, CHUNK_SIZE)
-    proba = predict_chunks(chunks).reshape((16, 16, 4))
-    board = get_board_bg(proba)
-    robots = get_robots(chunks.reshape((16, 16, 64, 64, 3)), proba[:, :, 3])
-    board["robots"] = robots
+    board = build_boards([img])[0]
+    if isinstance(board, BoardBuilderException):
+        raise board
     return board
 
 
-def clean_solution(board, winning_state):
+def build_boards(imgs):
+    """
+    Build several boards at once.
+    Images are projected in a thread pool, then each classifier runs once
+    over the chunks of all the images
+    returns: a board, or the BoardBuilderException raised, for each image
+    """
+    def try_get_square(img):
+        try:
+            return get_square(img)
+        except BoardBuilderException as e:
+            return e
+
+    with ThreadPoolExecutor() as executor:
+        projected = list(executor.map(try_get_square, imgs))
+    valid = [i for i, p in enumerate(projected) if not isinstance(p, BoardBuilderException)]
+    if not valid:
+        return projected
+
+    grids = [chunk_grid(projected[i], CHUNK_SIZE) for i in valid]
+    chunks = np.concatenate([grid.reshape((-1,) + grid.shape[2:]) for grid in grids])
+    probas = predict_chunks(chunks).reshape((len(valid), 16, 16, 4))
+
+    candidates = [get_robot_candidates(proba[:, :, 3]) for proba in probas]
+    robot_chunks = np.concatenate([
+        grid[coords[:, 0], coords[:, 1]] for grid, coords in zip(grids, candidates)
+    ])
+    robot_probas = np.split(
+        predict_robots(robot_chunks), np.cumsum([len(c) for c in candidates])[:-1]
+    )
+
+    boards = list(projected)
+    for i, proba, coords, robot_proba in zip(valid, probas, candidates, robot_probas):
+        board = board_json(get_board_bg(proba))
+        board["robots"] = assign_robots(coords, proba[:, :, 3], robot_proba)
+        boards[i] = board
+    return boards
+
+
+def clean_solution(board, path):
+    """
+    Turn a solution path into the final board and the list of moves, last move first
+    """
     new_board = board.copy()
-    new_board["robots"] = winning_state["robots"]
+    if path is None:
+        return new_board, None
+    steps = list(path_robots(path))
+    new_board["robots"] = steps[-1]
     moves = []
-    while True:
-        if not winning_state["prev_state"]:
-            break
+    for robots, prev_robots in zip(steps[:0:-1], steps[-2::-1]):
         moving_robot = [
-            robot
-            for robot in winning_state["robots"]
-            if winning_state["robots"][robot]
-            != winning_state["prev_state"]["robots"][robot]
+            robot for robot in robots if robots[robot] != prev_robots[robot]
         ][0]
-        moves.append((
-            moving_robot,
-            winning_state["robots"][moving_robot],
-            winning_state["prev_state"]["robots"][moving_robot],
-        ))
-        winning_state = winning_state["prev_state"]
+        moves.append((moving_robot, robots[moving_robot], prev_robots[moving_robot]))
     return new_board, moves
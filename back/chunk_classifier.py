@@ -1,4 +1,6 @@
 import pickle
+import sys
+import time
 
 import albumentations as A
 import cv2
@@ -6,18 +8,63 @@ import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 from sklearn import svm
+from sklearn.linear_model import LogisticRegression
 from sklearn.metrics import (
     accuracy_score,
 )
 from sklearn.model_selection import train_test_split
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
 
-from configs import DATA_PATH
+from configs import CHUNK_BACKEND, DATA_PATH, MODELS_PATH
+from model_registry import get_model
 
 
-def learn():
+# model file of each classifier backend
+CHUNK_MODELS = {"svc": "chunk_model.pkl", "fast": "chunk_fast_model.pkl"}
+
+
+def chunk_features(chunks, backend="svc"):
+    """
+    Turn a batch of chunks (n, 64, 64, 3) into a feature matrix.
+    svc: raw pixels.
+    fast: 8x8 downsampled pixels and hue/saturation histograms
+    """
+    chunks = np.asarray(chunks)
+    n = len(chunks)
+    if backend == "svc":
+        return chunks.reshape((n, -1))
+
+    # process the whole batch as a single tall image, histograms are
+    # computed on 16x16 chunks
+    tall = chunks.reshape((-1, chunks.shape[2], 3))
+    medium = cv2.resize(tall, (16, n * 16), interpolation=cv2.INTER_AREA)
+    small = cv2.resize(medium, (8, n * 8), interpolation=cv2.INTER_AREA)
+    small = small.reshape((n, -1)) / 255
+
+    hsv = cv2.cvtColor(medium, cv2.COLOR_BGR2HSV).reshape((n, -1, 3))
+    offsets = np.arange(n, dtype=np.int32)[:, None]
+    hue = offsets * 12 + hsv[:, :, 0] // 15
+    sat = offsets * 4 + hsv[:, :, 1] // 64
+    hue = np.bincount(hue.ravel(), minlength=n * 12)
+    sat = np.bincount(sat.ravel(), minlength=n * 4)
+    hists = np.hstack([hue.reshape((n, 12)), sat.reshape((n, 4))]) / (16 * 16)
+    return np.hstack([small, hists])
+
+
+def make_model(backend="svc"):
+    """
+    Untrained chunk classifier for the given backend
+    """
+    if backend == "svc":
+        return svm.SVC(probability=True)
+    return make_pipeline(StandardScaler(), LogisticRegression(max_iter=1000))
+
+
+def learn(backend="svc"):
     """
     Train a model to predict the labels of the chunks
-    Save the model
+    Save the model, and compare it with the other trained backends
     """
     labels = ["center", "empty", "goal", "robot"]
     labels_path = [(DATA_PATH / "sorted_chunks" / label) for label in labels]
@@ -37,7 +84,7 @@ def learn():
     for i, label_path in enumerate(labels_path):
         for chunk in label_path.glob("*.png"):
             img = transform(image=cv2.imread(str(chunk)))["image"]
-            X.append(img.flatten())
+            X.append(img)
             y.append(i)
 
     X = np.array(X)
@@ -50,38 +97,47 @@ def learn():
     X_train, X_test, y_train, y_test = train_test_split(
         X, y, test_size=0.20, random_state=0, stratify=y
     )
-    model = svm.SVC(probability=True)
+    model = make_model(backend)
     # model = GridSearchCV(svc, param_grid)
-    model.fit(X_train, y_train)
+    model.fit(chunk_features(X_train, backend), y_train)
 
-    pickle.dump(model, open("models/chunk_model.pkl", "wb"))
+    with open(MODELS_PATH / CHUNK_MODELS[backend], "wb") as f:
+        pickle.dump(model, f)
 
-    y_pred = model.predict(X_test)
-    acc = accuracy_score(y_pred, y_test)
-    print(acc)
+    compare(X_test, y_test)
 
     # print(classification_report(y_test, y_pred, target_names=labels))
     # cm = confusion_matrix(y_test, y_pred, labels=range(len(labels)))
     # disp = ConfusionMatrixDisplay(confusion_matrix=cm, display_labels=labels)
     # disp.plot()
     # plt.show()
-    transform = A.Compose(
-        [
-            A.ColorJitter(p=0.5, hue=(0, 0.05)),
-            A.RandomGamma(p=0.5),
-            A.Blur(p=0.5),
-            A.RandomRotate90(p=0.5),
-        ]
-    )
 
 
-def predict_chunks(chunks):
+def compare(X_test, y_test, n_runs=10):
+    """
+    Print the accuracy and the latency of a full board prediction (256 chunks)
+    for every trained backend
+    """
+    board = np.resize(X_test, (256,) + X_test.shape[1:])
+    for backend, name in CHUNK_MODELS.items():
+        if not (MODELS_PATH / name).exists():
+            continue
+        model = get_model(name)
+        acc = accuracy_score(model.predict(chunk_features(X_test, backend)), y_test)
+        t0 = time.perf_counter()
+        for _ in range(n_runs):
+            model.predict_proba(chunk_features(board, backend))
+        latency = (time.perf_counter() - t0) / n_runs
+        print("{}: accuracy {:.4f}, board latency {:.1f} ms".format(backend, acc, latency * 1000))
+
+
+def predict_chunks(chunks, backend=CHUNK_BACKEND):
     """
     Predict the labels of the chunks
     """
-    X = [chunk.flatten() for chunk in chunks]
+    X = chunk_features(chunks, backend)
 
-    model = pickle.load(open("models/chunk_model.pkl", "rb"))
+    model = get_model(CHUNK_MODELS[backend])
 
     y_pred = model.predict_proba(X)
     return y_pred
@@ -110,4 +166,4 @@ def sort():
 
 
 if __name__ == "__main__":
-    learn()
+    learn(*sys.argv[1:])
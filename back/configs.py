@@ -2,11 +2,51 @@ from pathlib import Path
 
 DEBUG = True
 DATA_PATH = Path("data")
+MODELS_PATH = Path("models")
+# Precomputed tables of every board layout, built with `python scripts.py database`
+DATABASE_PATH = Path("database")
+
+# Uploaded pictures are kept for training, written in the background
+PICTURES_PATH = Path("pictures")
+PICTURES_SAMPLE_RATE = 1.0  # fraction of the uploads that are kept
+PICTURES_MAX_FILES = 10000  # oldest pictures are removed past this, None to keep all
+PICTURES_QUEUE_SIZE = 64  # uploads are dropped while this many are waiting
+
+# Chunk classifier backend, see chunk_classifier.CHUNK_MODELS
+CHUNK_BACKEND = "svc"
 
 CHUNK_SIZE = 64
 BOARD_SIZE = 16
 IMG_SIZE = CHUNK_SIZE * BOARD_SIZE
 
+# Size of the downscaled image used to find the board lines, None to use IMG_SIZE.
+# Edges are then fitted at full resolution, corners stay within 1px of the full size path
+PROXY_SIZE = 384
+
+# Number of chunks, ranked by robot probability, sent to the robot classifier
+ROBOT_CANDIDATES = 8
+
+# Seconds before an idle streaming read session is dropped
+STREAM_SESSION_TTL = 60
+# Max streaming read sessions kept by each worker, the least recently seen are dropped
+# first. Any frame starts a session for its id, this bounds the memory they can take
+STREAM_MAX_SESSIONS = 64
+
+# Number of solutions kept by /solve, in memory or in a sqlite file shared by all the
+# workers if SOLUTION_CACHE_PATH is set
+SOLUTION_CACHE_SIZE = 10000
+SOLUTION_CACHE_PATH = None
+
+# Number of compiled tables (board walls, goal distances) kept by the solver
+MOVE_TABLES_CACHE_SIZE = 512
+
+# Seconds of search allowed to /solve_all when the client sets no deadline
+SOLVE_ALL_DEADLINE = 5
+
+# Max worker processes started by each parallel_solve or parallel_layer_solve call,
+# every gunicorn worker can run one
+PARALLEL_SOLVER_PROCESSES = 4
+
 QUARTERS = [
     {  # y 0
         "walls": [
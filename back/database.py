@@ -0,0 +1,95 @@
+import json
+import threading
+
+import numpy as np
+
+from bitboard import to_square
+from configs import DATABASE_PATH
+from move_tables import board_hash, cached, compile_walls, goal_distances, move_distances
+
+# Distances that don't fit in a byte, ie unreachable squares
+UNREACHABLE = 255
+
+# Database files:
+# tables.npy: uint8 (layouts, 4, BOARD_SIZE**2), compiled wall tables of each layout
+# distances.npy: uint8 (goals, 2, BOARD_SIZE**2), for each goal of each layout
+#   the goal_distances lower bound and the single robot move_distances
+# index.json: board hash -> [layout row, {goal square: distances row}]
+_database = None
+_lock = threading.Lock()
+
+
+def to_bytes(distances):
+    return [UNREACHABLE if d == float("inf") else d for d in distances]
+
+
+def to_distances(row):
+    return [float("inf") if d == UNREACHABLE else int(d) for d in row]
+
+
+def build(boards, path=DATABASE_PATH):
+    """
+    Compute the tables of every board and goal, and write them to path
+    boards: list of board backgrounds (ie walls+goals)
+    """
+    index = {}
+    tables = []
+    distances = []
+    for board in boards:
+        stops = compile_walls(board["walls"])
+        goals = {}
+        for xy in board["goals"].values():
+            goal = to_square(xy)
+            goals[goal] = len(distances)
+            distances.append(
+                [to_bytes(goal_distances(board["walls"], goal)), to_bytes(move_distances(stops, goal))]
+            )
+        index[board_hash(board["walls"])] = [len(tables), goals]
+        tables.append(stops)
+
+    path.mkdir(parents=True, exist_ok=True)
+    np.save(path / "tables.npy", np.array(tables, dtype=np.uint8))
+    np.save(path / "distances.npy", np.array(distances, dtype=np.uint8))
+    with open(path / "index.json", "w") as f:
+        json.dump(index, f)
+
+
+def load(path=DATABASE_PATH):
+    """
+    Open the database once per process, or return None if it wasn't built.
+    Arrays are memory mapped, so all the processes share them through the page cache
+    """
+    global _database
+    with _lock:
+        if _database is None and (path / "index.json").exists():
+            with open(path / "index.json") as f:
+                index = json.load(f)
+            _database = {
+                "index": index,
+                "tables": np.load(path / "tables.npy", mmap_mode="r"),
+                "distances": np.load(path / "distances.npy", mmap_mode="r"),
+            }
+    return _database
+
+
+def lookup(walls, goal):
+    """
+    Tables of a board and goal from the database
+    goal: square index
+    returns: compiled wall tables, goal_distances and move_distances, or None if unknown
+    """
+    database = load()
+    key = board_hash(walls)
+    if database is None or key not in database["index"]:
+        return None
+    layout, goals = database["index"][key]
+    if str(goal) not in goals:
+        return None
+    # converted once and kept in the move tables cache, the wall tables
+    # under the same key as get_move_tables
+    stops = cached(key, lambda: [row.tolist() for row in database["tables"][layout]])
+    lower_bound, moves = cached(
+        ("database", key, goal),
+        lambda: [to_distances(row) for row in database["distances"][goals[str(goal)]]],
+    )
+    return stops, lower_bound, moves
@@ -5,19 +5,16 @@ import imageio.v3 as iio
 import numpy as np
 from matplotlib import colors
 
+from bitboard import column_walls, get_masks, row_walls
 from configs import BOARD_SIZE
+from solver import path_robots
 
 CHUNK_SIZE = 32
 
 
-def render_path(walls, state, robot_name, goal=None):
+def render_path(walls, path, robot_name, goal=None):
     """Display all the states along the path we took"""
-    count = 0
-    images = []
-    while state is not None:
-        images = [render_board(state["robots"], walls, goal)] + images
-        state = state["prev_state"]
-        count += 1
+    images = [render_board(robots, walls, goal) for robots in path_robots(path)]
     gif = io.BytesIO()
     iio.imwrite(gif, images, extension=".gif", duration=600)
     gif.seek(0)
@@ -55,19 +52,24 @@ def render_grid(board):
     return board
 
 
-def render_wall(board, x, y):
-    """Draws a wall at x, y on the board"""
-    x1 = int(CHUNK_SIZE * np.ceil(y))
-    y1 = int(CHUNK_SIZE * np.ceil(x))
-    x2 = int(CHUNK_SIZE * (np.floor(y) + 1))
-    y2 = int(CHUNK_SIZE * (np.floor(x) + 1))
-    cv.line(board, (x1, y1), (x2, y2), color=(0, 0, 0), thickness=3)
+def render_walls(board, masks):
+    """Draws the walls of the direction masks on the board"""
+    for square in row_walls(masks):
+        x, y = divmod(square, BOARD_SIZE)
+        start = (CHUNK_SIZE * y, CHUNK_SIZE * (x + 1))
+        end = (CHUNK_SIZE * (y + 1), CHUNK_SIZE * (x + 1))
+        cv.line(board, start, end, color=(0, 0, 0), thickness=3)
+    for square in column_walls(masks):
+        x, y = divmod(square, BOARD_SIZE)
+        start = (CHUNK_SIZE * (y + 1), CHUNK_SIZE * x)
+        end = (CHUNK_SIZE * (y + 1), CHUNK_SIZE * (x + 1))
+        cv.line(board, start, end, color=(0, 0, 0), thickness=3)
 
 
 def render_board(robots, walls, goal=None):
     """Draw the board
     robots: dictionary of name: (x,y)
-    walls: list of (x,y) tuples
+    walls: list of (x,y) tuples, or compiled board
     goal: optional (x,y)"""
     h = w = CHUNK_SIZE * 16
     board = np.full((h, w, 3), 255, np.uint8)
@@ -88,7 +90,6 @@ def render_board(robots, walls, goal=None):
     render_grid(board)
 
     # add walls
-    for x, y in walls:
-        render_wall(board, x, y)
+    render_walls(board, get_masks(walls))
 
     return board
@@ -0,0 +1,34 @@
+import pickle
+import threading
+
+from configs import MODELS_PATH
+
+# model file name -> (mtime, model)
+_models = {}
+_lock = threading.Lock()
+
+
+def get_model(name):
+    """
+    Get a pickled model, loaded once per process.
+    The model is reloaded when its file changes on disk
+    """
+    path = MODELS_PATH / name
+    mtime = path.stat().st_mtime
+    with _lock:
+        entry = _models.get(name)
+        if entry is None or entry[0] != mtime:
+            with open(path, "rb") as f:
+                entry = (mtime, pickle.load(f))
+            _models[name] = entry
+    return entry[1]
+
+
+def preload(names=("chunk_model.pkl", "robot_model.pkl")):
+    """
+    Load models ahead of time, eg. before gunicorn forks its workers
+    so that they share the models memory
+    """
+    for name in names:
+        if (MODELS_PATH / name).exists():
+            get_model(name)
@@ -0,0 +1,175 @@
+import hashlib
+import threading
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from bitboard import DOWN, LEFT, RIGHT, UP, get_masks
+from configs import BOARD_SIZE, MOVE_TABLES_CACHE_SIZE
+
+STEPS = ((0, 1), (0, -1), (1, 0), (-1, 0))
+
+
+def wall_key(walls):
+    """Hashable key of a wall list or compiled board, however the walls are written"""
+    return tuple(get_masks(walls))
+
+
+def board_hash(walls):
+    """Short hash of a wall set, used to identify a board"""
+    return hashlib.md5(repr(wall_key(walls)).encode()).hexdigest()
+
+
+def compile_walls(walls):
+    """For each square and direction, find the square where a robot stops,
+    ignoring other robots.
+    walls: list of walls or compiled board
+    returns: 4 lists (up, down, right, left) of BOARD_SIZE**2 square indices"""
+    masks = get_masks(walls)
+    stops = []
+    for direction, (dx, dy) in enumerate(STEPS):
+        stops.append([])
+        for square in range(BOARD_SIZE * BOARD_SIZE):
+            x, y = divmod(square, BOARD_SIZE)
+            while (
+                not masks[direction] >> (x * BOARD_SIZE + y) & 1
+                and 0 <= x + dx < BOARD_SIZE
+                and 0 <= y + dy < BOARD_SIZE
+            ):
+                x, y = x + dx, y + dy
+            stops[direction].append(x * BOARD_SIZE + y)
+    return stops
+
+
+def robot_moves(stops, squares, i):
+    """returns all the squares robot i can reach, given all robot squares.
+    stops: compiled wall tables
+    returns: square indices (up, down, right, left)"""
+    current = squares[i]
+    up, down = stops[UP][current], stops[DOWN][current]
+    right, left = stops[RIGHT][current], stops[LEFT][current]
+
+    # robots on the way block the move one square before them
+    for square in squares:
+        if current < square <= up:
+            up = square - 1
+        elif down <= square < current:
+            down = square + 1
+        elif (square - current) % BOARD_SIZE == 0:
+            if current < square <= right:
+                right = square - BOARD_SIZE
+            elif left <= square < current:
+                left = square + BOARD_SIZE
+    return up, down, right, left
+
+
+def layer_moves(stops, layer, i):
+    """Vectorized robot_moves, for robot i of a whole layer of states at once.
+    stops: compiled wall tables, as a (4, BOARD_SIZE**2) array
+    layer: (states, robots) array of robot squares
+    returns: (4, states) array of the squares reached going up, down, right and left"""
+    current = layer[:, i]
+    up, down, right, left = stops[:, current]
+
+    # robots on the way block the move one square before them
+    for j in range(layer.shape[1]):
+        if j == i:
+            continue
+        square = layer[:, j]
+        up = np.where((current < square) & (square <= up), square - 1, up)
+        down = np.where((down <= square) & (square < current), square + 1, down)
+        same_row = (square - current) % BOARD_SIZE == 0
+        blocks_right = same_row & (current < square) & (square <= right)
+        right = np.where(blocks_right, square - BOARD_SIZE, right)
+        blocks_left = same_row & (left <= square) & (square < current)
+        left = np.where(blocks_left, square + BOARD_SIZE, left)
+    return np.stack([up, down, right, left])
+
+
+def goal_distances(walls, goal):
+    """Minimum number of moves for a robot to reach the goal square,
+    if it could stop anywhere along its way. Never overestimates the real
+    number of moves, whatever the other robots do.
+    goal: square index
+    returns: list of BOARD_SIZE**2 distances, inf where the goal can't be reached"""
+    masks = get_masks(walls)
+    distances = [float("inf")] * (BOARD_SIZE * BOARD_SIZE)
+    distances[goal] = 0
+    q = deque([goal])
+    while len(q) > 0:
+        square = q.popleft()
+        for direction, (dx, dy) in enumerate(STEPS):
+            x, y = divmod(square, BOARD_SIZE)
+            while (
+                not masks[direction] >> (x * BOARD_SIZE + y) & 1
+                and 0 <= x + dx < BOARD_SIZE
+                and 0 <= y + dy < BOARD_SIZE
+            ):
+                x, y = x + dx, y + dy
+                if distances[x * BOARD_SIZE + y] > distances[square] + 1:
+                    distances[x * BOARD_SIZE + y] = distances[square] + 1
+                    q.append(x * BOARD_SIZE + y)
+    return distances
+
+
+def move_distances(stops, goal):
+    """Number of moves for a robot alone on the board to reach the goal square,
+    stopping only against walls. Other robots can make it shorter or longer.
+    stops: compiled wall tables
+    goal: square index
+    returns: list of BOARD_SIZE**2 distances, inf where the goal can't be reached"""
+    # squares from which one move stops on each square
+    sources = [[] for _ in range(BOARD_SIZE * BOARD_SIZE)]
+    for direction_stops in stops:
+        for square, stop in enumerate(direction_stops):
+            if stop != square:
+                sources[stop].append(square)
+
+    distances = [float("inf")] * (BOARD_SIZE * BOARD_SIZE)
+    distances[goal] = 0
+    q = deque([goal])
+    while len(q) > 0:
+        square = q.popleft()
+        for source in sources[square]:
+            if distances[source] == float("inf"):
+                distances[source] = distances[square] + 1
+                q.append(source)
+    return distances
+
+
+_tables_cache = OrderedDict()
+_tables_lock = threading.Lock()
+
+
+def cached(key, compute):
+    """Gets key from the thread safe LRU cache, computing it if needed"""
+    with _tables_lock:
+        if key in _tables_cache:
+            _tables_cache.move_to_end(key)
+            return _tables_cache[key]
+
+    # compute outside of the lock so that other boards aren't kept waiting
+    value = compute()
+
+    with _tables_lock:
+        value = _tables_cache.setdefault(key, value)
+        _tables_cache.move_to_end(key)
+        while len(_tables_cache) > MOVE_TABLES_CACHE_SIZE:
+            _tables_cache.popitem(last=False)
+    return value
+
+
+def get_move_tables(walls):
+    """Compiled wall tables for the given walls.
+    Tables are kept in a thread safe LRU cache keyed by the board hash"""
+    return cached(board_hash(walls), lambda: compile_walls(walls))
+
+
+def get_move_arrays(walls):
+    """Cached compiled wall tables, as a (4, BOARD_SIZE**2) array for layer_moves"""
+    return cached(("arrays", board_hash(walls)), lambda: np.array(get_move_tables(walls), np.int16))
+
+
+def get_goal_distances(walls, goal):
+    """Cached goal_distances for the given board and goal square"""
+    return cached((board_hash(walls), goal), lambda: goal_distances(walls, goal))
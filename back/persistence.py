@@ -0,0 +1,94 @@
+import hashlib
+import os
+import queue
+import random
+import threading
+
+from configs import PICTURES_MAX_FILES, PICTURES_PATH, PICTURES_QUEUE_SIZE, PICTURES_SAMPLE_RATE
+
+# (bytes, extension) waiting to be written by the worker thread
+_queue = queue.Queue(maxsize=PICTURES_QUEUE_SIZE)
+_worker_pid = None
+_worker_lock = threading.Lock()
+# pictures in PICTURES_PATH as counted by this process, other workers' writes
+# are only picked up when the directory is listed again to prune it
+_picture_count = None
+
+
+def start_worker():
+    """
+    Start the writer thread of this process.
+    Threads don't survive a fork, so each gunicorn worker starts its own on first use
+    """
+    global _worker_pid
+    with _worker_lock:
+        if _worker_pid != os.getpid():
+            threading.Thread(target=run_worker, daemon=True).start()
+            _worker_pid = os.getpid()
+
+
+def save_picture(data, extension):
+    """
+    Queue an uploaded picture to be written to PICTURES_PATH, without waiting on disk.
+    Pictures are sampled at PICTURES_SAMPLE_RATE, and dropped when the queue is full
+    data: the original file bytes
+    returns: whether the picture was queued
+    """
+    if random.random() >= PICTURES_SAMPLE_RATE:
+        return False
+    start_worker()
+    try:
+        _queue.put_nowait((data, extension))
+    except queue.Full:
+        return False
+    return True
+
+
+def write_picture(data, extension):
+    """
+    Write a picture named after its content hash, then apply the retention limit.
+    The directory is only listed once the count goes past PICTURES_MAX_FILES
+    """
+    global _picture_count
+    PICTURES_PATH.mkdir(parents=True, exist_ok=True)
+    path = PICTURES_PATH / f"{hashlib.sha256(data).hexdigest()[:32]}{extension}"
+    if path.exists():
+        path.touch()
+        return
+    tmp_path = path.with_name(path.name + ".tmp")
+    tmp_path.write_bytes(data)
+    tmp_path.replace(path)
+
+    if PICTURES_MAX_FILES is None:
+        return
+    if _picture_count is None:
+        _picture_count = len(list_pictures())
+    else:
+        _picture_count += 1
+    if _picture_count > PICTURES_MAX_FILES:
+        pictures = sorted(list_pictures(), key=lambda p: p.stat().st_mtime)
+        for old in pictures[: max(0, len(pictures) - PICTURES_MAX_FILES)]:
+            old.unlink(missing_ok=True)
+        _picture_count = min(len(pictures), PICTURES_MAX_FILES)
+
+
+def list_pictures():
+    return [p for p in PICTURES_PATH.iterdir() if p.suffix != ".tmp"]
+
+
+def run_worker():
+    while True:
+        data, extension = _queue.get()
+        try:
+            write_picture(data, extension)
+        except OSError as e:
+            print(f"Could not save picture: {e}")
+        finally:
+            _queue.task_done()
+
+
+def flush():
+    """
+    Wait for all the queued pictures to be written
+    """
+    _queue.join()
@@ -10,7 +10,8 @@ from sklearn.metrics import (
 )
 from sklearn.model_selection import train_test_split
 
-from configs import DATA_PATH
+from configs import DATA_PATH, MODELS_PATH
+from model_registry import get_model
 
 
 def learn():
@@ -49,7 +50,8 @@ def learn():
     # model = GridSearchCV(svc, param_grid)
     model.fit(X_train, y_train)
 
-    pickle.dump(model, open("models/robot_model.pkl", "wb"))
+    with open(MODELS_PATH / "robot_model.pkl", "wb") as f:
+        pickle.dump(model, f)
 
     y_pred = model.predict(X_test)
     acc = accuracy_score(y_pred, y_test)
@@ -66,9 +68,9 @@ def predict_robots(chunks):
     """
     Predict the labels of the chunks
     """
-    X = np.array([chunk.flatten() for chunk in chunks])
+    X = np.reshape(chunks, (len(chunks), -1))
 
-    model = pickle.load(open("models/robot_model.pkl", "rb"))
+    model = get_model("robot_model.pkl")
 
     y_pred = model.predict_proba(X)
     return y_pred
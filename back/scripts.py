@@ -1,8 +1,10 @@
 import hashlib
+import sys
 
 import cv2
 
-from board_builder import get_square, resample
+import database
+from board_builder import board_layouts, chunk_list, get_square, make_board
 from configs import CHUNK_SIZE, DATA_PATH
 
 
@@ -14,7 +16,18 @@ def main():
     for i, img_path in enumerate(imgs_path):
         img = cv2.imread(str(img_path))
         projected = get_square(img)
-        chunks = resample(projected, CHUNK_SIZE)
+        chunks = chunk_list(projected, CHUNK_SIZE)
         for chunk in chunks:
             hash = hashlib.md5(chunk.tobytes()).hexdigest()
             cv2.imwrite(str(DATA_PATH / "chunks" / f"{hash}.jpg"), chunk)
+
+
+def build_database():
+    """
+    Precompute the solver tables of every board layout, see database.py
+    """
+    database.build([make_board(qlabels) for qlabels in board_layouts()])
+
+
+if __name__ == "__main__":
+    {"chunks": main, "database": build_database}[sys.argv[1]]()
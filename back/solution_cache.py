@@ -0,0 +1,111 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from bitboard import to_coords, to_square
+from configs import BOARD_SIZE, SOLUTION_CACHE_PATH, SOLUTION_CACHE_SIZE
+from solver import pack, unpack
+
+# solution key -> path in the canonical orientation, when SOLUTION_CACHE_PATH is None
+_cache = OrderedDict()
+_lock = threading.Lock()
+# one sqlite connection per thread, they can't be shared
+_local = threading.local()
+
+
+def rotate(xy, quarter_turns):
+    """
+    Rotate a square or wall coords by quarter turns around the center of the board
+    """
+    x, y = xy
+    for _ in range(quarter_turns % 4):
+        x, y = y, BOARD_SIZE - 1 - x
+    return x, y
+
+
+def solution_key(walls, robots, robot, goal, solver):
+    """
+    Key of a problem, the same for the 4 rotations of a board.
+    returns: the key, and the quarter turns from the problem to the cached orientation
+    """
+    candidates = []
+    for turns in range(4):
+        candidates.append((
+            repr((
+                sorted(tuple(map(float, rotate(xy, turns))) for xy in walls),
+                sorted((name, tuple(map(int, rotate(xy, turns)))) for name, xy in robots.items()),
+                robot,
+                tuple(map(int, rotate(goal, turns))),
+                solver,
+            )),
+            turns,
+        ))
+    problem, turns = min(candidates)
+    return hashlib.sha256(problem.encode()).hexdigest(), turns
+
+
+def rotate_path(path, quarter_turns):
+    """
+    Rotate the robot squares of every state of a solution path
+    """
+    states = []
+    for state in path["states"]:
+        squares = unpack(state, len(path["names"]))
+        states.append(pack([to_square(rotate(to_coords(square), quarter_turns)) for square in squares]))
+    return dict(path, states=states)
+
+
+def get_connection():
+    if getattr(_local, "connection", None) is None:
+        _local.connection = sqlite3.connect(SOLUTION_CACHE_PATH, timeout=10)
+        _local.connection.execute(
+            "CREATE TABLE IF NOT EXISTS solutions (key TEXT PRIMARY KEY, path TEXT, used REAL)"
+        )
+        _local.connection.execute("CREATE INDEX IF NOT EXISTS solutions_used ON solutions (used)")
+    return _local.connection
+
+
+def get_solution(key, quarter_turns):
+    """
+    Get a cached solution path, in the orientation of the problem, or None
+    """
+    if SOLUTION_CACHE_PATH is None:
+        with _lock:
+            path = _cache.get(key)
+            if path is not None:
+                _cache.move_to_end(key)
+    else:
+        with get_connection() as connection:
+            row = connection.execute("SELECT path FROM solutions WHERE key = ?", (key,)).fetchone()
+            if row is not None:
+                connection.execute("UPDATE solutions SET used = ? WHERE key = ?", (time.time(), key))
+        path = None if row is None else json.loads(row[0])
+    return None if path is None else rotate_path(path, -quarter_turns)
+
+
+def set_solution(key, quarter_turns, path):
+    """
+    Cache a solution path given in the orientation of the problem,
+    removing the least recently used ones past SOLUTION_CACHE_SIZE
+    """
+    path = rotate_path(path, quarter_turns)
+    if SOLUTION_CACHE_PATH is None:
+        with _lock:
+            _cache[key] = path
+            _cache.move_to_end(key)
+            while len(_cache) > SOLUTION_CACHE_SIZE:
+                _cache.popitem(last=False)
+    else:
+        with get_connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO solutions VALUES (?, ?, ?)",
+                (key, json.dumps(path), time.time()),
+            )
+            connection.execute(
+                "DELETE FROM solutions WHERE key IN "
+                "(SELECT key FROM solutions ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                (SOLUTION_CACHE_SIZE,),
+            )
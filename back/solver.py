@@ -1,127 +1,158 @@
-import math
+import heapq
+import os
 import time
-from collections import defaultdict, deque
+from array import array
+from multiprocessing import (
+    Pipe,
+    Pool,
+    Process,
+    TimeoutError,
+    resource_tracker,
+    shared_memory,
+)
 
-from configs import BOARD_SIZE, DEBUG
+import numpy as np
 
-# State Vector
-# dict(robots=dict(color=(x,y), cost=0, prev_state=None))
+from bitboard import to_coords, to_square
+from configs import BOARD_SIZE, DEBUG, PARALLEL_SOLVER_PROCESSES
+from database import lookup
+from move_tables import (
+    compile_walls,
+    get_goal_distances,
+    get_move_arrays,
+    get_move_tables,
+    layer_moves,
+    move_distances,
+    robot_moves,
+)
 
+# Robot that must reach a goal, from the first letter of the goal name
+GOAL_ROBOTS = {"r": "red", "g": "green", "b": "blue", "y": "yellow"}
 
-def extremes(current, arr):
-    """Find the highest and lowest available spots,
-    given current value and array of obstacles.
-    returns (up, down) available locations"""
-    up = BOARD_SIZE
-    down = -1
-    for v in arr:
-        if v > current and v < up:
-            up = v
-        elif v < current and v > down:
-            down = v
+# Walls
+# list of (x,y) walls, or compiled board, see bitboard
 
-    # fix rounding of walls/robots
-    up = math.ceil(up)
-    down = math.floor(down)
-    return up, down
+# Start State
+# dict(robots=dict(color=(x,y)), cost=0, prev_state=None)
 
+# Searched states are packed integers, 8 bits per robot square, stored in
+# typed arrays along with the index of their parent state.
 
-extreme_cache = None
+# Solution Path
+# dict(names=[color, ...], states=[packed state, ...], cost=number of moves)
 
 
-def cache_wall_extremes(walls):
-    """For each location on the board, create a list of the extreme wall positions"""
-    global extreme_cache
-    extreme_cache = {}
-    for current_x in range(BOARD_SIZE):
-        for current_y in range(BOARD_SIZE):
+def pack(squares):
+    """Packs a list of robot squares into a single integer, 8 bits per robot"""
+    state = 0
+    for i, square in enumerate(squares):
+        state |= square << (8 * i)
+    return state
 
-            xs, ys = [], []
-            for x, y in walls:
-                if x == current_x:
-                    ys.append(y)
-                if y == current_y:
-                    xs.append(x)
 
-            # find closest walls/robots in all directions
-            up_y, down_y = extremes(current_y, ys)
-            right_x, left_x = extremes(current_x, xs)
+def unpack(state, n_robots):
+    """Unpacks an integer state into a list of robot squares"""
+    return [(state >> (8 * i)) & 0xFF for i in range(n_robots)]
 
-            extreme_cache[(current_x, current_y)] = (up_y, down_y, right_x, left_x)
 
+def canonical(squares):
+    """Packs squares so that helper robots are interchangeable.
+    The goal robot always comes first, the others are sorted."""
+    return pack([squares[0]] + sorted(squares[1:]))
 
-def get_next_states(robot_name, moves, state, blacklist):
-    """packages next moves into actual states.
-    robot_name: which robot we're moving.
-    moves: a tuple of move coords that are possible
-    state: current state vector.
-    blacklist: don't send a robot to a location that's been sufficiently explored"""
-    next_states = []
-    for coord in moves:  # new coordinates for the moved robot
 
-        # ignore moves that are stuck in the same place
-        if coord == state["robots"][robot_name]:
-            continue
-        # ignore moves that bring us back to the robot's previous location
-        elif (
-            state["prev_state"] is not None
-            and coord == state["prev_state"]["robots"][robot_name]
-        ):
-            continue
-        # ignore moves that bring us to a very explored location
-        elif blacklist[robot_name][coord] > blacklist["limit"]:
-            continue
-        # let's try it!
-        else:
-            blacklist[robot_name][coord] += 1
+def get_names(start_state, goal_robot_name=None):
+    """Robot names in packing order, the goal robot comes first"""
+    names = list(start_state["robots"])
+    if goal_robot_name is not None:
+        names.remove(goal_robot_name)
+        names.insert(0, goal_robot_name)
+    return names
+
+
+def new_nodes(state):
+    """Typed arrays holding searched states and the index of their parent"""
+    return array("L", [state]), array("l", [-1])
 
-            # create a new state to add to the queue
-            s = {}
-            s["robots"] = state["robots"].copy()
-            s["robots"][robot_name] = coord
-            s["cost"] = state["cost"] + 1
-            s["prev_state"] = state
-            next_states.append(s)
-    return next_states
 
+def trace_path(names, states, parents, node):
+    """Follows parent indices back to the start, only for the winning node.
+    returns: a solution path"""
+    path = []
+    while node != -1:
+        path.append(states[node])
+        node = parents[node]
+    return make_path(names, path[::-1])
 
-def get_robot_moves(robot_name, state, walls):
+
+def make_path(names, states):
+    """Builds a solution path from packed states, the first one being the start"""
+    return {"names": names, "states": list(states), "cost": len(states) - 1}
+
+
+def path_robots(path):
+    """Iterates over the robot positions along a solution path.
+    returns: dicts of name: (x, y) for each step, starting with the start"""
+    for state in path["states"]:
+        squares = unpack(state, len(path["names"]))
+        yield {name: to_coords(square) for name, square in zip(path["names"], squares)}
+
+
+def get_robot_moves(robot_name, state, stops):
     """returns all possible next moves for the given robot.
     robot_name: a string name of a robot.
     state: a state object
+    stops: compiled wall tables, see move_tables.compile_walls
     returns: tuples of coords that robot can move to. (up, down, right, left)"""
-    current_x, current_y = state["robots"][robot_name]
-
-    # find walls and robots with same x coord or y coord
-    if extreme_cache is None:
-        cache_wall_extremes(walls)
-
-    up_y, down_y, right_x, left_x = extreme_cache[(current_x, current_y)]
-    xs, ys = [right_x, left_x], [up_y, down_y]  # add wall extremes to list
-    to_check = list(state["robots"].values())  # then check over robots
-
-    for x, y in to_check:
-        if x == current_x:
-            ys.append(y)
-        if y == current_y:
-            xs.append(x)
-
-    # find closest walls/robots in all directions
-    up_y, down_y = extremes(current_y, ys)
-    right_x, left_x = extremes(current_x, xs)
-
-    # create record tuples (up, down, right, left)
-    return (
-        (current_x, up_y - 1),  # need to go off by 1, for places robot can actually go
-        (current_x, down_y + 1),
-        (right_x - 1, current_y),
-        (left_x + 1, current_y),
-    )
+    names = list(state["robots"])
+    squares = [to_square(state["robots"][name]) for name in names]
+    moves = robot_moves(stops, squares, names.index(robot_name))
+    return tuple(to_coords(square) for square in moves)
 
 
-def win(state, robot_name, goal):
-    """Checks if the current state wins"""
-    return state["robots"][robot_name] == goal
+def new_stats(deadline=None, max_nodes=None):
+    """Search statistics, and the budget the search must stay in.
+    deadline: max number of seconds of search
+    max_nodes: max number of expanded states"""
+    t0 = time.time()
+    return {
+        "status": "running",
+        "nodes": 0,
+        "time": 0.0,
+        "start": t0,
+        "deadline": None if deadline is None else t0 + deadline,
+        "max_nodes": max_nodes,
+    }
+
+
+def out_of_budget(stats, nodes=1):
+    """Counts expanded states, and checks if the search must stop"""
+    stats["nodes"] += nodes
+    if stats["max_nodes"] is not None and stats["nodes"] > stats["max_nodes"]:
+        stats["status"] = "node budget exceeded"
+    elif stats["deadline"] is not None and time.time() > stats["deadline"]:
+        stats["status"] = "deadline exceeded"
+    return stats["status"] != "running"
+
+
+def report(stats, path):
+    """Finalizes search statistics once a solver returned.
+    A path returned once the budget ran out keeps the budget status, it is only the
+    best one found so far.
+    returns: the statistics that are worth sending to a client"""
+    stats["time"] = time.time() - stats["start"]
+    if path is not None:
+        stats["cost"] = path["cost"]
+        stats["best_so_far"] = stats["status"] != "running"
+        if stats["status"] == "running":
+            stats["status"] = "solved"
+    elif stats["status"] == "running":
+        stats["status"] = "unsolved"
+    return {
+        key: stats[key]
+        for key in ("status", "nodes", "time", "cost", "best_so_far")
+        if key in stats
+    }
 
 
 def solve_case(
@@ -132,6 +163,7 @@ def solve_case(
     movable_robots=None,
     blacklist_limit=20,
     cost_limit=20,
+    stats=None,
 ):
     """find the shortest number of moves to solve, given a number of options.
     start_state: initial conditions of board
@@ -139,135 +171,810 @@ def solve_case(
     goal: (x,y) of where to get it
     movable_robots: list of robot names we can move
     blacklist_limit: max times we'll look at once place
-    cost_limit: max steps"""
-    q = deque()  # a queue to keep track of our rough BFS
-    q.append(start_state)
+    cost_limit: max steps
+    stats: search statistics and budget, see new_stats"""
+    stats = new_stats() if stats is None else stats
+    stops = get_move_tables(walls)
+    names = get_names(start_state, goal_robot_name)
+    target = to_square(goal)
+
+    # states are appended in BFS order, so the arrays are also our queue
+    states, parents = new_nodes(pack([to_square(start_state["robots"][name]) for name in names]))
+    costs = array("B", [0])
+    node = 0
 
     # for reporting
     cost = 0
     t0 = time.time()
 
     # we use a global blacklist to stop ourselves from visiting the same point too many times
-    blacklist = {name: defaultdict(int) for name in start_state["robots"]}
-    blacklist["limit"] = blacklist_limit
+    blacklist = [[0] * BOARD_SIZE * BOARD_SIZE for _ in names]
 
     # which robots are we allowed to move?
     if movable_robots is None:
-        movable_robots = start_state["robots"].keys()
-
-    while len(q) > 0:
-        state = q.popleft()
+        movable_robots = names
+    movable = [names.index(name) for name in movable_robots]
 
-        if state["cost"] > cost_limit:
+    while node < len(states):
+        if costs[node] > cost_limit or out_of_budget(stats):
             return None
 
+        if DEBUG and costs[node] > cost:
+            cost = costs[node]
+            print("step: {} time: {}".format(cost, time.time() - t0))
+
+        squares = unpack(states[node], len(names))
+        prev_squares = None if parents[node] == -1 else unpack(states[parents[node]], len(names))
+        for i in movable:
+            for square in robot_moves(stops, squares, i):
+                # ignore moves that are stuck in the same place
+                if square == squares[i]:
+                    continue
+                # ignore moves that bring us back to the robot's previous location
+                elif prev_squares is not None and square == prev_squares[i]:
+                    continue
+                # ignore moves that bring us to a very explored location
+                elif blacklist[i][square] > blacklist_limit:
+                    continue
+                # let's try it!
+                blacklist[i][square] += 1
+                next_squares = squares.copy()
+                next_squares[i] = square
+                states.append(pack(next_squares))
+                parents.append(node)
+                costs.append(costs[node] + 1)
+
+                if i == 0 and square == target:
+                    return trace_path(names, states, parents, len(states) - 1)
+        node += 1
+
+    # ran out of search options
+    return None
+
+
+def optimal_solve(walls, start_state, goal_robot_name, goal, cost_limit=20, stats=None):
+    """Exact BFS over packed integer states, returns a shortest solution.
+    Each state is visited once. Helper robots are interchangeable, so
+    configurations that only differ by a swap of helpers are merged.
+    cost_limit: max steps
+    stats: search statistics and budget, see new_stats"""
+    stats = new_stats() if stats is None else stats
+    stops = get_move_tables(walls)
+
+    names = get_names(start_state, goal_robot_name)
+    squares = [to_square(start_state["robots"][name]) for name in names]
+    target = to_square(goal)
+    if squares[0] == target:
+        return make_path(names, [pack(squares)])
+
+    # states are appended layer by layer, a layer is a range of nodes
+    states, parents = new_nodes(pack(squares))
+    seen = {canonical(squares)}
+    layer = range(0, 1)
+
+    # for reporting
+    t0 = time.time()
+
+    for cost in range(1, cost_limit + 1):
         if DEBUG:
-            new_cost = state["cost"]
-            if new_cost > cost:
-                cost = new_cost
-                print("step: {} time: {}".format(cost, time.time() - t0))
+            print("step: {} states: {} time: {}".format(cost, len(states), time.time() - t0))
+
+        for node in layer:
+            if out_of_budget(stats):
+                return None
+            squares = unpack(states[node], len(names))
+            for i in range(len(names)):
+                for square in robot_moves(stops, squares, i):
+                    if square == squares[i]:
+                        continue
+                    next_squares = squares.copy()
+                    next_squares[i] = square
+                    key = canonical(next_squares)
+                    if key in seen:
+                        continue
+                    seen.add(key)
+                    states.append(pack(next_squares))
+                    parents.append(node)
+
+                    if i == 0 and square == target:
+                        return trace_path(names, states, parents, len(states) - 1)
+        if layer.stop == len(states):
+            break
+        layer = range(layer.stop, len(states))
+
+    # ran out of search options
+    return None
+
 
-        next_states = []
-        for robot_name in movable_robots:
-            moves = get_robot_moves(robot_name, state, walls)
-            next_states.extend(get_next_states(robot_name, moves, state, blacklist))
+def pack_layer(layer):
+    """Vectorized pack, for a (states, robots) array of squares"""
+    shifts = np.arange(layer.shape[1], dtype=np.uint64) * np.uint64(8)
+    return np.bitwise_or.reduce(layer.astype(np.uint64) << shifts, axis=1)
+
+
+def canonical_layer(layer):
+    """Vectorized canonical, for a (states, robots) array of squares"""
+    return pack_layer(np.concatenate([layer[:, :1], np.sort(layer[:, 1:], axis=1)], axis=1))
+
+
+def expand_layer(stops, layer):
+    """Every successor of a layer of states, moving each robot in each direction.
+    stops: compiled wall tables, as an array
+    returns: the (successors, robots) array of squares, and the index of their parent"""
+    successors, parents = [], []
+    for i in range(layer.shape[1]):
+        for squares in layer_moves(stops, layer, i):
+            moved = np.flatnonzero(squares != layer[:, i])
+            next_layer = layer[moved]
+            next_layer[:, i] = squares[moved]
+            successors.append(next_layer)
+            parents.append(moved)
+    return np.concatenate(successors), np.concatenate(parents)
+
+
+def trace_layers(names, history, node):
+    """Follows parent indices back through the layers, for a node of the last one.
+    history: (packed states, parent indices) of each layer
+    returns: a solution path"""
+    path = []
+    for states, parents in history[::-1]:
+        path.append(int(states[node]))
+        node = parents[node]
+    return make_path(names, path[::-1])
+
+
+def layer_solve(walls, start_state, goal_robot_name, goal, cost_limit=20, stats=None):
+    """Exact BFS like optimal_solve, expanding a whole layer at a time with numpy.
+    Successors of all the states, robots and directions are generated at once
+    by layer_moves, and deduplicated with np.unique on their canonical keys.
+    Faster than optimal_solve once the frontier is wide.
+    cost_limit: max steps
+    stats: search statistics and budget, see new_stats"""
+    stats = new_stats() if stats is None else stats
+    stops = get_move_arrays(walls)
+
+    names = get_names(start_state, goal_robot_name)
+    squares = [to_square(start_state["robots"][name]) for name in names]
+    target = to_square(goal)
+    if squares[0] == target:
+        return make_path(names, [pack(squares)])
+
+    layer = np.array([squares], dtype=np.int16)
+    seen = np.array([canonical(squares)], dtype=np.uint64)
+    # packed states of each layer, and the index of their parent in the previous one
+    history = [(pack_layer(layer), np.array([-1]))]
+
+    # for reporting
+    t0 = time.time()
+
+    for cost in range(1, cost_limit + 1):
+        if DEBUG:
+            print("step: {} states: {} time: {}".format(cost, len(seen), time.time() - t0))
+        if out_of_budget(stats, len(layer)):
+            return None
 
-        for next_state in next_states:
-            if win(next_state, goal_robot_name, goal):
-                return next_state
-            q.append(next_state)
+        layer, parents = expand_layer(stops, layer)
+
+        # keep the first state of each new canonical key
+        keys, first = np.unique(canonical_layer(layer), return_index=True)
+        new = ~np.isin(keys, seen, assume_unique=True)
+        if not new.any():
+            break
+        layer, parents = layer[first[new]], parents[first[new]]
+        seen = np.union1d(seen, keys[new])
+        history.append((pack_layer(layer), parents))
+
+        won = np.flatnonzero(layer[:, 0] == target)
+        if len(won) > 0:
+            return trace_layers(names, history, won[0])
 
     # ran out of search options
     return None
 
 
-def full_solve(walls, start_state, goal_robot_name, goal):
-    """Solves the board by calling solve_case many times with different parameters.
-    1. only move the goal robot
-    2. solve with all robots, low blacklist depth
-    3. solve with all robots, high blacklist depth"""
-    cache_wall_extremes(walls)
-
-    print("Trying to only move main robot")
-    result = solve_case(
-        walls,
-        start_state,
-        goal_robot_name,
-        goal,
-        movable_robots=[goal_robot_name],
-        blacklist_limit=float("inf"),
-        cost_limit=15,
-    )
-    if result:
-        return result
-
-    print("moving all robots, with low blacklist limit")
-    result = solve_case(
-        walls,
-        start_state,
-        goal_robot_name,
-        goal,
-        movable_robots=None,
-        blacklist_limit=20,
-        cost_limit=15,
-    )
-    if result:
-        return result
+def get_shard(keys, n_shards):
+    """Visited set shard of canonical keys, from a multiplicative hash"""
+    return (keys * np.uint64(0x9E3779B97F4A7C15) >> np.uint64(32)) % np.uint64(n_shards)
+
+
+def bucket_dtype(n_robots):
+    """Successor record exchanged between the parallel_layer_solve workers"""
+    return np.dtype([("key", np.uint64), ("parent", np.int64), ("squares", np.int16, (n_robots,))])
+
+
+def write_bucket(records):
+    """Copies records to a new shared memory block, read and unlinked by read_bucket.
+    returns: the name of the block, None when there are no records"""
+    if len(records) == 0:
+        return None
+    memory = shared_memory.SharedMemory(create=True, size=records.nbytes)
+    np.ndarray(records.shape, dtype=records.dtype, buffer=memory.buf)[:] = records
+    memory.close()
+    return memory.name
+
+
+def read_bucket(name, count, dtype):
+    memory = shared_memory.SharedMemory(name=name)
+    records = np.ndarray((count,), dtype=dtype, buffer=memory.buf).copy()
+    memory.close()
+    memory.unlink()
+    return records
+
+
+def shard_worker(conn, stops, shard_index, n_shards, layer, target):
+    """Worker process of parallel_layer_solve, holding one shard of the visited set
+    and the states of each layer that belong to it.
+    layer: its states of the first layer
+    Runs the commands sent by the main process until it gets None:
+    ("expand", offset): expands its states of the last layer, offset being the index of
+        the first one in the whole layer. The successors of each shard are written to
+        shared memory, sends back the (name, count) bucket of each shard
+    ("merge", buckets): reads the buckets of its shard from every worker, the states that
+        were never seen are its part of the next layer. Sends back their count and the
+        index of one where the goal robot reaches the target, or -1
+    ("trace", depth, node): sends back the packed state of one of its states and the
+        index of its parent in the whole previous layer"""
+    dtype = bucket_dtype(layer.shape[1])
+    seen = np.unique(canonical_layer(layer))
+    history = [(pack_layer(layer), np.full(len(layer), -1))]
+    while True:
+        command = conn.recv()
+        if command is None:
+            break
+        if command[0] == "expand":
+            _, offset = command
+            successors, parents = expand_layer(stops, layer)
+            keys, first = np.unique(canonical_layer(successors), return_index=True)
+            records = np.empty(len(keys), dtype=dtype)
+            records["key"] = keys
+            records["parent"] = parents[first] + offset
+            records["squares"] = successors[first]
+            shards = get_shard(keys, n_shards)
+            conn.send([
+                (write_bucket(records[shards == i]), int(np.count_nonzero(shards == i)))
+                for i in range(n_shards)
+            ])
+        elif command[0] == "merge":
+            _, buckets = command
+            records = np.concatenate(
+                [np.empty(0, dtype=dtype)]
+                + [read_bucket(name, count, dtype) for name, count in buckets if name is not None]
+            )
+            keys, first = np.unique(records["key"], return_index=True)
+            new = ~np.isin(keys, seen, assume_unique=True)
+            seen = np.union1d(seen, keys[new])
+            records = records[first[new]]
+            layer = records["squares"]
+            history.append((pack_layer(layer), records["parent"]))
+            won = np.flatnonzero(layer[:, 0] == target)
+            conn.send((len(layer), int(won[0]) if len(won) > 0 else -1))
+        else:
+            _, depth, node = command
+            states, parents = history[depth]
+            conn.send((int(states[node]), int(parents[node])))
+
+
+def receive_all(workers, stats):
+    """Receives one message from each parallel_layer_solve worker, waiting no longer
+    than the search deadline.
+    returns: the messages, or None with the stats status set when the deadline passed
+    or a worker died"""
+    messages = []
+    for _, conn in workers:
+        timeout = None
+        if stats["deadline"] is not None:
+            timeout = max(0, stats["deadline"] - time.time())
+        if not conn.poll(timeout):
+            stats["status"] = "deadline exceeded"
+            return None
+        try:
+            messages.append(conn.recv())
+        except EOFError:
+            stats["status"] = "worker failed"
+            return None
+    return messages
 
-    print("move 1 other robot at a time, low blacklist")
-    other_robots = [rob for rob in start_state["robots"] if rob != goal_robot_name]
-    for robot in other_robots:
-        print("Trying {}".format(robot))
-        result = solve_case(
-            walls,
-            start_state,
-            goal_robot_name,
-            goal,
-            movable_robots=[goal_robot_name, robot],
-            blacklist_limit=200,
-            cost_limit=15,
+
+def unlink_buckets(buckets):
+    """Unlinks the shared memory blocks of buckets that may not have been read"""
+    for name, _ in buckets:
+        if name is None:
+            continue
+        try:
+            memory = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            continue
+        memory.close()
+        memory.unlink()
+
+
+def trace_shards(names, workers, counts, worker, node):
+    """trace_layers for parallel_layer_solve, each state being asked to the worker holding it.
+    counts: number of states of each worker in each layer
+    returns: a solution path"""
+    path = []
+    for depth in range(len(counts) - 1, -1, -1):
+        _, conn = workers[worker]
+        conn.send(("trace", depth, node))
+        state, parent = conn.recv()
+        path.append(state)
+        if depth > 0:
+            ends = np.cumsum(counts[depth - 1])
+            worker = int(np.searchsorted(ends, parent, side="right"))
+            node = parent - int(ends[worker]) + counts[depth - 1][worker]
+    return make_path(names, path[::-1])
+
+
+def parallel_layer_solve(
+    walls, start_state, goal_robot_name, goal, cost_limit=20, stats=None, processes=None
+):
+    """layer_solve with each layer split between worker processes.
+    The visited set and the layers are sharded by a hash of the canonical keys. Each
+    worker expands its states of the layer, and writes the successors of each shard
+    to a shared memory block read by the worker owning the shard, which keeps the
+    ones it never saw. The main process only coordinates, with the number of new
+    states of each worker. Compare it with layer_solve on a multi-core machine with
+    python benchmark.py --modes layer parallel_layer --no-memory
+    cost_limit: max steps
+    stats: search statistics and budget, see new_stats
+    processes: number of workers, defaults to the number of cores up to
+    PARALLEL_SOLVER_PROCESSES"""
+    stats = new_stats() if stats is None else stats
+    stops = get_move_arrays(walls)
+    n_workers = processes or min(os.cpu_count(), PARALLEL_SOLVER_PROCESSES)
+
+    names = get_names(start_state, goal_robot_name)
+    squares = [to_square(start_state["robots"][name]) for name in names]
+    target = to_square(goal)
+    if squares[0] == target:
+        return make_path(names, [pack(squares)])
+
+    start = np.array([squares], dtype=np.int16)
+    owner = int(get_shard(np.array([canonical(squares)], dtype=np.uint64), n_workers)[0])
+    # workers must share our resource tracker, or theirs would warn about the
+    # shared memory blocks they exchange
+    resource_tracker.ensure_running()
+    workers = []
+    for i in range(n_workers):
+        conn, worker_conn = Pipe()
+        layer = start if i == owner else start[:0]
+        process = Process(
+            target=shard_worker,
+            args=(worker_conn, stops, i, n_workers, layer, target),
+            daemon=True,
         )
-        if result:
-            return result
+        process.start()
+        # only the worker holds its end, so that we get EOFError if it dies
+        worker_conn.close()
+        workers.append((process, conn))
+    # number of states of each worker in each layer
+    counts = [[int(i == owner) for i in range(n_workers)]]
+
+    # for reporting
+    t0 = time.time()
+
+    # whether the workers may still be running a command
+    busy = False
+    buckets = []
+    try:
+        for cost in range(1, cost_limit + 1):
+            size = sum(counts[-1])
+            if DEBUG:
+                print("step: {} states: {} time: {}".format(cost, size, time.time() - t0))
+            if out_of_budget(stats, size):
+                return None
+
+            offsets = np.cumsum([0] + counts[-1][:-1])
+            for (_, conn), offset in zip(workers, offsets):
+                conn.send(("expand", int(offset)))
+            busy = True
+            buckets = receive_all(workers, stats)
+            if buckets is None:
+                return None
+            for i, (_, conn) in enumerate(workers):
+                conn.send(("merge", [worker_buckets[i] for worker_buckets in buckets]))
+            merged = receive_all(workers, stats)
+            if merged is None:
+                return None
+            busy = False
+            counts.append([count for count, _ in merged])
+            if sum(counts[-1]) == 0:
+                break
+
+            for worker, (_, won) in enumerate(merged):
+                if won >= 0:
+                    return trace_shards(names, workers, counts, worker, won)
+    finally:
+        for process, conn in workers:
+            if busy:
+                # stopped waiting on the layer, the worker may have died or be expanding it
+                process.terminate()
+            else:
+                try:
+                    conn.send(None)
+                except BrokenPipeError:
+                    process.terminate()
+            process.join()
+        if busy and buckets:
+            for worker_buckets in buckets:
+                unlink_buckets(worker_buckets)
+
+    # ran out of search options
+    return None
+
+
+def astar_solve(
+    walls, start_state, goal_robot_name, goal, cost_limit=30, stats=None, stops=None, distances=None
+):
+    """A* over packed integer states, returns a shortest solution.
+    The heuristic is the number of moves the goal robot would need if it
+    could stop anywhere, which never overestimates the real cost.
+    cost_limit: max steps
+    stats: search statistics and budget, see new_stats
+    stops, distances: precomputed wall tables and goal_distances, eg. from the database"""
+    stats = new_stats() if stats is None else stats
+    stops = get_move_tables(walls) if stops is None else stops
+    target = to_square(goal)
+    distances = get_goal_distances(walls, target) if distances is None else distances
+
+    names = get_names(start_state, goal_robot_name)
+    squares = [to_square(start_state["robots"][name]) for name in names]
+    if squares[0] == target:
+        return make_path(names, [pack(squares)])
+    if distances[squares[0]] > cost_limit:
+        return None
+
+    states, parents = new_nodes(pack(squares))
+    # canonical state -> best known cost
+    costs = {canonical(squares): 0}
+    # (estimated total cost, -cost, node)
+    q = [(distances[squares[0]], 0, 0)]
+
+    while len(q) > 0:
+        _, cost, node = heapq.heappop(q)
+        cost = -cost
+        squares = unpack(states[node], len(names))
+        if costs[canonical(squares)] < cost:
+            continue  # already expanded with a lower cost
+        if out_of_budget(stats):
+            return None
+
+        for i in range(len(names)):
+            for square in robot_moves(stops, squares, i):
+                if square == squares[i]:
+                    continue
+                next_squares = squares.copy()
+                next_squares[i] = square
+                estimate = cost + 1 + distances[next_squares[0]]
+                if estimate > cost_limit:
+                    continue
+                key = canonical(next_squares)
+                if costs.get(key, cost_limit + 1) <= cost + 1:
+                    continue
+                costs[key] = cost + 1
+                states.append(pack(next_squares))
+                parents.append(node)
+
+                if i == 0 and square == target:
+                    return trace_path(names, states, parents, len(states) - 1)
+
+                heapq.heappush(q, (estimate, -cost - 1, len(states) - 1))
+
+    # ran out of search options
+    return None
+
+
+def get_board_tables(walls, goal):
+    """Wall tables, goal_distances and move_distances of a board and goal square,
+    from the solution database when the board is in it"""
+    tables = lookup(walls, goal)
+    if tables is None:
+        stops = get_move_tables(walls)
+        tables = stops, get_goal_distances(walls, goal), move_distances(stops, goal)
+    return tables
+
+
+def database_solve(walls, start_state, goal_robot_name, goal, cost_limit=30, stats=None):
+    """Answers from the solution database, then searches for a shorter solution if needed.
+    The goal robot first follows its single robot shortest route, as long as the
+    other robots don't get in the way. That route is optimal when its cost meets the
+    goal_distances lower bound; otherwise A* looks for a shorter one, and the route
+    is returned if there is none or the budget runs out.
+    cost_limit: max steps
+    stats: search statistics and budget, see new_stats"""
+    stats = new_stats() if stats is None else stats
+    target = to_square(goal)
+    stops, lower_bound, moves = get_board_tables(walls, target)
+
+    names = get_names(start_state, goal_robot_name)
+    squares = [to_square(start_state["robots"][name]) for name in names]
+    route = [pack(squares)]
+    while 0 < moves[squares[0]] < float("inf") and len(route) <= cost_limit:
+        for square in robot_moves(stops, squares, 0):
+            if moves[square] == moves[squares[0]] - 1:
+                squares[0] = square
+                route.append(pack(squares))
+                break
+        else:
+            break  # blocked by another robot
+    if squares[0] != target:
+        return astar_solve(
+            walls, start_state, goal_robot_name, goal, cost_limit, stats, stops, lower_bound
+        )
+
+    path = make_path(names, route)
+    if path["cost"] <= lower_bound[to_square(start_state["robots"][goal_robot_name])]:
+        return path
+    shorter = astar_solve(
+        walls, start_state, goal_robot_name, goal, path["cost"] - 1, stats, stops, lower_bound
+    )
+    return path if shorter is None else shorter
+
+
+def bidirectional_solve(walls, start_state, goal_robot_name, goal, cost_limit=15, stats=None):
+    """Meet in the middle search where only the goal robot moves.
+    Searches forward from the robot and backward from the goal, using the
+    squares from which a move stops on a given square.
+    Returns a shortest solution that doesn't move the other robots.
+    cost_limit: max steps
+    stats: search statistics and budget, see new_stats"""
+    stats = new_stats() if stats is None else stats
+    stops = get_move_tables(walls)
+    names = get_names(start_state, goal_robot_name)
+    squares = [to_square(start_state["robots"][name]) for name in names]
+    start, target = squares[0], to_square(goal)
+    if start == target:
+        return make_path(names, [pack(squares)])
+
+    # other robots don't move: precompute moves and reverse moves for every square
+    forward = [[] for _ in range(BOARD_SIZE * BOARD_SIZE)]
+    backward = [[] for _ in range(BOARD_SIZE * BOARD_SIZE)]
+    for square in range(BOARD_SIZE * BOARD_SIZE):
+        if square in squares[1:]:
+            continue
+        for next_square in set(robot_moves(stops, [square] + squares[1:], 0)):
+            if next_square != square:
+                forward[square].append(next_square)
+                backward[next_square].append(square)
+
+    # square -> previous square from the start, next square to the goal
+    parents, children = {start: None}, {target: None}
+    costs, remaining = {start: 0}, {target: 0}
+    forward_layer, backward_layer = [start], [target]
+
+    while forward_layer and backward_layer:
+        if costs[forward_layer[0]] + remaining[backward_layer[0]] >= cost_limit:
+            break
+
+        # grow the smallest frontier by one full layer
+        if len(forward_layer) <= len(backward_layer):
+            layer, moves, seen, depth, other = forward_layer, forward, parents, costs, remaining
+        else:
+            layer, moves, seen, depth, other = backward_layer, backward, children, remaining, costs
+
+        next_layer = []
+        for square in layer:
+            if out_of_budget(stats):
+                return None
+            for next_square in moves[square]:
+                if next_square not in seen:
+                    seen[next_square] = square
+                    depth[next_square] = depth[square] + 1
+                    next_layer.append(next_square)
+        if layer is forward_layer:
+            forward_layer = next_layer
+        else:
+            backward_layer = next_layer
+
+        # both searches met, keep the shortest junction of this layer
+        meets = [square for square in next_layer if square in other]
+        if meets:
+            meet = min(meets, key=lambda square: costs[square] + remaining[square])
+            path = [meet]
+            while parents[path[0]] is not None:
+                path.insert(0, parents[path[0]])
+            while children[path[-1]] is not None:
+                path.append(children[path[-1]])
+            return make_path(names, [pack([square] + squares[1:]) for square in path])
 
-    print("move 1 other robot at a time")
+    # ran out of search options
+    return None
+
+
+def solve_all_goals(walls, start_state, goals, cost_limit=6, stats=None):
+    """Solves every goal of the board with a single BFS sweep from the start.
+    The first time a robot reaches a goal is a shortest solution for it.
+    Goals that are still unsolved after cost_limit steps are then solved one
+    by one with astar_solve.
+    goals: dict of goal name: (x, y), the first letter of a name is the color
+    of its robot, "m" goals accept any robot
+    stats: search statistics and budget, see new_stats
+    returns: dict of goal name: solution path, or None if unsolved"""
+    stats = new_stats() if stats is None else stats
+    stops = get_move_tables(walls)
+
+    names = get_names(start_state)
+    squares = [to_square(start_state["robots"][name]) for name in names]
+
+    # goal square -> list of (goal name, indices of the robots that can win there)
+    pending = {}
+    solutions = {name: None for name in goals}
+    for name, goal in goals.items():
+        robots = [
+            i for i, robot in enumerate(names)
+            if name[0] == "m" or GOAL_ROBOTS.get(name[0]) == robot
+        ]
+        if any(squares[i] == to_square(goal) for i in robots):
+            solutions[name] = make_path(names, [pack(squares)])
+        elif robots:
+            pending.setdefault(to_square(goal), []).append((name, robots))
+
+    # states are appended layer by layer, a layer is a range of nodes
+    states, parents = new_nodes(pack(squares))
+    seen = {pack(squares)}
+    layer = range(0, 1)
+
+    for cost in range(1, cost_limit + 1):
+        for node in layer:
+            if not pending or out_of_budget(stats):
+                break
+            squares = unpack(states[node], len(names))
+            for i in range(len(names)):
+                for square in robot_moves(stops, squares, i):
+                    if square == squares[i]:
+                        continue
+                    next_squares = squares.copy()
+                    next_squares[i] = square
+                    next_state = pack(next_squares)
+                    if next_state in seen:
+                        continue
+                    seen.add(next_state)
+                    states.append(next_state)
+                    parents.append(node)
+
+                    if square not in pending:
+                        continue
+                    for name, robots in pending[square]:
+                        if i in robots:
+                            solutions[name] = trace_path(names, states, parents, len(states) - 1)
+                    pending[square] = [goal for goal in pending[square] if solutions[goal[0]] is None]
+                    if not pending[square]:
+                        del pending[square]
+        if not pending or stats["status"] != "running":
+            break
+        layer = range(layer.stop, len(states))
+
+    # goals too far away for the sweep
+    for goal_square, remaining in pending.items():
+        for name, robots in remaining:
+            for i in robots:
+                if stats["status"] != "running":
+                    return solutions
+                result = astar_solve(
+                    walls, start_state, names[i], to_coords(goal_square), stats=stats
+                )
+                if result and (solutions[name] is None or result["cost"] < solutions[name]["cost"]):
+                    solutions[name] = result
+
+    return solutions
+
+
+def get_strategies(start_state, goal_robot_name):
+    """List the passes tried by full_solve, from the cheapest to the most expensive.
+    returns: list of (description, solver, kwargs)"""
     other_robots = [rob for rob in start_state["robots"] if rob != goal_robot_name]
+    strategies = [
+        ("Trying to only move main robot", bidirectional_solve, dict(cost_limit=15)),
+        (
+            "moving all robots, with low blacklist limit",
+            solve_case,
+            dict(movable_robots=None, blacklist_limit=20, cost_limit=15),
+        ),
+    ]
     for robot in other_robots:
-        print("Trying {}".format(robot))
-        result = solve_case(
-            walls,
-            start_state,
-            goal_robot_name,
-            goal,
-            movable_robots=[goal_robot_name, robot],
-            blacklist_limit=2000,
-            cost_limit=10,
-        )
+        strategies.append((
+            "move 1 other robot at a time, low blacklist, trying {}".format(robot),
+            solve_case,
+            dict(movable_robots=[goal_robot_name, robot], blacklist_limit=200, cost_limit=15),
+        ))
+    for robot in other_robots:
+        strategies.append((
+            "move 1 other robot at a time, trying {}".format(robot),
+            solve_case,
+            dict(movable_robots=[goal_robot_name, robot], blacklist_limit=2000, cost_limit=10),
+        ))
+    strategies.append((
+        "moving all robots, with high blacklist limit",
+        solve_case,
+        dict(movable_robots=None, blacklist_limit=2000, cost_limit=15),
+    ))
+    return strategies
+
+
+def full_solve(walls, start_state, goal_robot_name, goal, stats=None):
+    """Solves the board by calling solve_case many times with different parameters.
+    1. only move the goal robot
+    2. solve with all robots, low blacklist depth
+    3. solve with the goal robot and one other robot
+    4. solve with all robots, high blacklist depth
+    stats: search statistics and budget shared by all passes, see new_stats"""
+    stats = new_stats() if stats is None else stats
+    for description, solver, kwargs in get_strategies(start_state, goal_robot_name):
+        print(description)
+        result = solver(walls, start_state, goal_robot_name, goal, stats=stats, **kwargs)
         if result:
             return result
-
-    print("moving all robots, with high blacklist limit")
-    result = solve_case(
-        walls,
-        start_state,
-        goal_robot_name,
-        goal,
-        movable_robots=None,
-        blacklist_limit=2000,
-        cost_limit=15,
-    )
-    if result:
-        return result
+        if stats["status"] != "running":
+            break
 
     return None
 
 
+def run_strategy(args):
+    """Runs one of the full_solve strategies, in a worker process.
+    returns: the winning state, the number of expanded states and the search status"""
+    walls, start_state, goal_robot_name, goal, solver, kwargs, stats = args
+    result = solver(walls, start_state, goal_robot_name, goal, stats=stats, **kwargs)
+    return result, stats["nodes"], stats["status"]
+
+
+def parallel_solve(walls, start_state, goal_robot_name, goal, stats=None, processes=None):
+    """Runs all the full_solve strategies at the same time in a process pool.
+    Without a deadline, returns the first solution found. With a deadline,
+    returns the shortest solution found in time.
+    stats: search statistics and budget, the node budget applies to each strategy
+    processes: size of the pool, defaults to the number of cores up to
+    PARALLEL_SOLVER_PROCESSES"""
+    stats = new_stats() if stats is None else stats
+    strategies = get_strategies(start_state, goal_robot_name)
+    tasks = [
+        (walls, start_state, goal_robot_name, goal, solver, kwargs, stats)
+        for _, solver, kwargs in strategies
+    ]
+    best = None
+
+    # leaving the pool terminates the strategies that are still running
+    with Pool(processes or min(len(tasks), os.cpu_count(), PARALLEL_SOLVER_PROCESSES)) as pool:
+        results = pool.imap_unordered(run_strategy, tasks)
+        while True:
+            timeout = None
+            if stats["deadline"] is not None:
+                timeout = max(0, stats["deadline"] - time.time())
+            try:
+                result, nodes, status = results.next(timeout=timeout)
+            except StopIteration:
+                break
+            except TimeoutError:
+                stats["status"] = "deadline exceeded"
+                break
+            stats["nodes"] += nodes
+            if status != "running":
+                stats["status"] = status
+            if result and (best is None or result["cost"] < best["cost"]):
+                best = result
+                if stats["deadline"] is None:
+                    break
+
+    return best
+
+
+SOLVERS = {
+    "full": full_solve,
+    "optimal": optimal_solve,
+    "astar": astar_solve,
+    "bidirectional": bidirectional_solve,
+    "parallel": parallel_solve,
+    "database": database_solve,
+    "layer": layer_solve,
+    "parallel_layer": parallel_layer_solve,
+}
+
+
 def test_get_robot_moves():
     robot_name = "red"
     walls = [(3.5, 1)]
     state = {"robots": {"red": (1, 1), "green": (1, 3)}, "cost": 0, "prev_state": None}
-    cache_wall_extremes(walls)
-    res = get_robot_moves(robot_name, state, walls=walls)
+    res = get_robot_moves(robot_name, state, compile_walls(walls))
     assert res == ((1, 2), (1, 0), (3, 1), (0, 1)), "got {}".format(res)
     print("robot move still works ;)")
 
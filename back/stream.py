@@ -0,0 +1,137 @@
+import threading
+import time
+import uuid
+
+import cv2
+import numpy as np
+
+from board_builder import (
+    crop_square,
+    find_corners,
+    get_homography,
+    image_resize,
+    make_board,
+    read_square,
+)
+from configs import IMG_SIZE, PROXY_SIZE, STREAM_MAX_SESSIONS, STREAM_SESSION_TTL
+
+# Streaming read sessions, kept in memory: each gunicorn worker has its own, and the
+# workers share one port so frames can't be routed to the worker of their session.
+# A frame reaching a worker that never saw its session starts it there from scratch,
+# it is read in full instead of tracked. Run a single worker (see Dockerfile) to track
+# every frame, each session holds about 1MB and at most STREAM_MAX_SESSIONS are kept.
+# session id -> {"lock", "last_seen", "grey", "corners", "homography", "qlabels", "board_bg"}
+_sessions = {}
+_lock = threading.Lock()
+
+LK_PARAMS = {
+    "winSize": (31, 31),
+    "maxLevel": 3,
+    "criteria": (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 20, 0.03),
+}
+
+
+def drop_expired(now):
+    """
+    Remove the sessions idle for more than STREAM_SESSION_TTL, must hold _lock
+    """
+    for session_id in [
+        session_id
+        for session_id, session in _sessions.items()
+        if now - session["last_seen"] > STREAM_SESSION_TTL
+    ]:
+        del _sessions[session_id]
+
+
+def start_session():
+    """
+    Open a new streaming read session
+    returns: the session id
+    """
+    now = time.time()
+    session_id = uuid.uuid4().hex
+    with _lock:
+        add_session(session_id, now)
+    return session_id
+
+
+def add_session(session_id, now):
+    """
+    Start a session, dropping the expired ones and the least recently seen ones
+    beyond STREAM_MAX_SESSIONS, must hold _lock
+    """
+    drop_expired(now)
+    while len(_sessions) >= STREAM_MAX_SESSIONS:
+        del _sessions[min(_sessions, key=lambda x: _sessions[x]["last_seen"])]
+    session = _sessions[session_id] = {"lock": threading.Lock(), "last_seen": now, "grey": None}
+    return session
+
+
+def close_session(session_id):
+    with _lock:
+        _sessions.pop(session_id, None)
+
+
+def get_session(session_id):
+    """
+    Get a session, creating it if this process does not know it yet (other worker, expired)
+    """
+    now = time.time()
+    with _lock:
+        drop_expired(now)
+        session = _sessions.get(session_id) or add_session(session_id, now)
+        session["last_seen"] = now
+    return session
+
+
+def track_corners(prev_grey, grey, corners, max_error=1.0):
+    """
+    Track the board corners from the previous frame with Lucas-Kanade optical flow.
+    Each corner is tracked back to the previous frame to check it
+    returns: the new corners, or None if any of them was lost
+    """
+    points = corners.astype(np.float32).reshape((-1, 1, 2))
+    tracked, status, _ = cv2.calcOpticalFlowPyrLK(prev_grey, grey, points, None, **LK_PARAMS)
+    back, back_status, _ = cv2.calcOpticalFlowPyrLK(grey, prev_grey, tracked, None, **LK_PARAMS)
+    error = np.linalg.norm(back - points, axis=2).ravel()
+    if not (status.all() and back_status.all() and (error < max_error).all()):
+        return None
+    return tracked.reshape((-1, 2)).astype(np.float64)
+
+
+def read_frame(session_id, img):
+    """
+    Read the board from a new frame of the session.
+    Corners are tracked from the previous frame when possible, and the board
+    background is reused if the quarters still match; otherwise the frame is read from scratch
+    returns: the board, and whether the corners were tracked
+    """
+    session = get_session(session_id)
+    img = image_resize(img, height=IMG_SIZE)
+    grey = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    with session["lock"]:
+        corners = None
+        if session["grey"] is not None and session["grey"].shape == grey.shape:
+            corners = track_corners(session["grey"], grey, session["corners"])
+
+        if corners is not None:
+            if np.abs(corners - session["corners"]).max() < 0.5:
+                # still camera, keep the previous homography
+                corners, homography = session["corners"], session["homography"]
+            else:
+                homography = get_homography(corners)
+            qlabels, robots = read_square(crop_square(img, corners, homography))
+            tracked = qlabels == session["qlabels"]
+
+        if corners is None or not tracked:
+            corners = find_corners(img, PROXY_SIZE)
+            homography = get_homography(corners)
+            qlabels, robots = read_square(crop_square(img, corners, homography))
+            session["qlabels"] = qlabels
+            session["board_bg"] = make_board(qlabels)
+            tracked = False
+
+        session.update({"grey": grey, "corners": corners, "homography": homography})
+        board = dict(session["board_bg"], robots=robots)
+    return board, tracked
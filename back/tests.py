@@ -1,19 +1,60 @@
+import os
+import time
+
 import cv2
 import numpy as np
 import requests
+from PIL import Image
 
+import api
 from bash_render import print_board, print_path
-from board_builder import build_board, get_quarters, get_robots, get_square, resample, clean_solution
-from chunk_classifier import predict_chunks
-from configs import DATA_PATH, CHUNK_SIZE
+from bitboard import board_json, compile_board, mask_walls, wall_masks
+import board_builder
+from board_builder import (
+    NotEnoughLinesException,
+    assign_robots,
+    build_board,
+    build_boards,
+    chunk_grid,
+    clean_solution,
+    decode_image,
+    find_corners,
+    get_quarters,
+    get_robot_candidates,
+    get_robots,
+    get_square,
+    image_resize,
+    make_board,
+)
+from chunk_classifier import chunk_features, predict_chunks
+from configs import DATA_PATH, CHUNK_SIZE, IMG_SIZE
 from img_render import render_board, render_path
-from solver import full_solve
+import database
+import persistence
+import solution_cache
+import solver
+import stream
+from solver import (
+    GOAL_ROBOTS,
+    SOLVERS,
+    astar_solve,
+    database_solve,
+    full_solve,
+    layer_solve,
+    optimal_solve,
+    new_stats,
+    parallel_layer_solve,
+    parallel_solve,
+    report,
+    solve_all_goals,
+)
+from stream import read_frame, start_session
 
 DATA = {
     "20240415_102619.jpg": {
         "quarters": [0, 6, 5, 3],
         "robots": {"red": [3, 7], "green": [4, 12], "yellow": [6, 4], "blue": [12, 2]},
-        "solutions": [("yellow", (8, 5), [('yellow', (8, 5), (6, 5)), ('yellow', (6, 5), [6, 4])])],
+        "solutions": [("yellow", (8, 5), [('yellow', (8, 5), (6, 5)), ('yellow', (6, 5), (6, 4))])],
     },
     "20240415_102648.jpg": {
         "quarters": [3, 5, 6, 0],
@@ -30,31 +71,179 @@ DATA = {
 }
 
 
+def test_decode_image():
+    # this picture has an EXIF orientation, that cv2.imread applies
+    path = DATA_PATH / "input" / "20240415_165822.jpg"
+    img = decode_image(Image.open(path))
+    assert img.shape == (1512, 1512, 3)
+    expected = cv2.resize(cv2.imread(str(path)), img.shape[:2], interpolation=cv2.INTER_AREA)
+    assert np.abs(img.astype(int) - expected).mean() < 5
+
+
 def test_quarters():
     for img_path, data in DATA.items():
         if "quarters" not in data:
             continue
         img = cv2.imread(str(DATA_PATH / "input" / img_path))
         projected = get_square(img)
-        chunks = resample(projected, CHUNK_SIZE)
-        proba = predict_chunks(chunks).reshape((16, 16, 4))
+        chunks = chunk_grid(projected, CHUNK_SIZE)
+        proba = predict_chunks(chunks.reshape((-1, CHUNK_SIZE, CHUNK_SIZE, 3))).reshape((16, 16, 4))
         quarters = get_quarters(proba)
         assert quarters == data["quarters"]
 
 
+def test_proxy_quarters():
+    for img_path, data in DATA.items():
+        if "quarters" not in data:
+            continue
+        img = cv2.imread(str(DATA_PATH / "input" / img_path))
+        projected = get_square(img, proxy_size=512)
+        chunks = chunk_grid(projected, CHUNK_SIZE)
+        proba = predict_chunks(chunks.reshape((-1, CHUNK_SIZE, CHUNK_SIZE, 3))).reshape((16, 16, 4))
+        quarters = get_quarters(proba)
+        assert quarters == data["quarters"]
+
+
+def test_proxy_corners():
+    for img_path in DATA:
+        img = image_resize(cv2.imread(str(DATA_PATH / "input" / img_path)), height=IMG_SIZE)
+        corners = find_corners(img)
+        for proxy_size in [384, 512]:
+            proxy_corners = find_corners(img, proxy_size)
+            assert np.linalg.norm(proxy_corners - corners, axis=1).max() < 1
+
+
+def test_fast_chunk_backend():
+    for img_path, data in DATA.items():
+        img = cv2.imread(str(DATA_PATH / "input" / img_path))
+        chunks = chunk_grid(get_square(img), CHUNK_SIZE).reshape((-1, CHUNK_SIZE, CHUNK_SIZE, 3))
+        features = chunk_features(chunks, "fast")
+        # 8x8 pixels, then 12 hue and 4 saturation bins
+        assert features.shape == (256, 8 * 8 * 3 + 16)
+        assert np.allclose(features[:, -16:-4].sum(axis=1), 1)
+        assert np.allclose(features[:, -4:].sum(axis=1), 1)
+        # chunks don't leak into each other when the batch is processed as one image
+        assert np.allclose(chunk_features(chunks[5:6], "fast"), features[5:6])
+
+        proba = predict_chunks(chunks, backend="fast")
+        assert proba.shape == (256, 4)
+        assert np.mean(proba.argmax(axis=1) == predict_chunks(chunks).argmax(axis=1)) > 0.95
+        assert get_quarters(proba.reshape((16, 16, 4))) == data["quarters"]
+
 def test_robots():
     for img_path, data in DATA.items():
         if "robots" not in data:
             continue
         img = cv2.imread(str(DATA_PATH / "input" / img_path))
         projected = get_square(img)
-        chunks = resample(projected, CHUNK_SIZE)
-        proba = predict_chunks(chunks).reshape((16, 16, 4))
-        robots = get_robots(chunks.reshape((16, 16, 64, 64, 3)), proba[:, :, 3])
+        chunks = chunk_grid(projected, CHUNK_SIZE)
+        proba = predict_chunks(chunks.reshape((-1, CHUNK_SIZE, CHUNK_SIZE, 3))).reshape((16, 16, 4))
+        robots = get_robots(chunks, proba[:, :, 3])
         for color in data["robots"]:
             assert robots[color] == data["robots"][color]
 
 
+
+def test_build_boards(monkeypatch):
+    imgs = [cv2.imread(str(DATA_PATH / "input" / img_path)) for img_path in list(DATA)[:3]]
+    # no board lines in a blank picture
+    imgs.insert(1, np.zeros((1024, 768, 3), dtype=np.uint8))
+    expected = [build_board(img) for img in imgs[:1] + imgs[2:]]
+
+    calls = []
+
+    def counted_predict_chunks(chunks):
+        calls.append(len(chunks))
+        return predict_chunks(chunks)
+
+    monkeypatch.setattr(board_builder, "predict_chunks", counted_predict_chunks)
+    boards = build_boards(imgs)
+    # a single classifier call over the chunks of the 3 pictures that were read
+    assert calls == [3 * 256]
+    assert isinstance(boards[1], NotEnoughLinesException)
+    assert boards[:1] + boards[2:] == expected
+
+def test_assign_robots():
+    proba = np.zeros((16, 16))
+    proba[1, 1], proba[1, 2], proba[5, 5], proba[9, 3], proba[12, 12] = 0.9, 0.8, 0.7, 0.6, 0.1
+    coords = get_robot_candidates(proba, k=4)
+    assert coords.tolist() == [[1, 1], [1, 2], [5, 5], [9, 3]]
+    assert get_robot_candidates(proba, k=4, nms=True).tolist() == [[1, 1], [5, 5], [9, 3], [12, 12]]
+    # yellow, red, green, blue: a greedy choice would give red to [1, 1]
+    robot_proba = np.array([
+        [0.1, 0.6, 0.2, 0.1],
+        [0.1, 0.8, 0.05, 0.05],
+        [0.6, 0.1, 0.2, 0.1],
+        [0.1, 0.1, 0.2, 0.6],
+    ])
+    robots = assign_robots(coords, proba, robot_proba)
+    assert robots == {"green": [1, 1], "red": [1, 2], "yellow": [5, 5], "blue": [9, 3]}
+
+
+def test_bitboard():
+    walls = [(3.5, 1), (0, 5.5), (15.5, 2), (-0.5, 4), (7, -0.5)]
+    assert sorted(mask_walls(wall_masks(walls))) == sorted(walls)
+    board = dict(make_board([0, 6, 5, 3]), robots={"red": [3, 7]})
+    compiled = compile_board(board)
+    assert compiled["robots"] == {"red": 3 * 16 + 7}
+    assert compile_board(board_json(compiled)) == compiled
+    assert sorted(map(tuple, board_json(compiled)["walls"])) == sorted(set(map(tuple, board["walls"])))
+    assert compile_board({"walls": walls})["goals"] == {}
+
+
+def test_solve_without_goals():
+    board = {"walls": [(3.5, 1), (0, 5.5)], "robots": {"red": (0, 0), "green": (15, 1)}}
+    response = api.app.test_client().post(
+        "/solve", json={"board": board, "goal": (14, 0), "robot": "red", "solver": "astar"}
+    )
+    assert response.json["msg"] == "success"
+    assert response.json["board"]["robots"]["red"] == [14, 0]
+
+
+def test_make_board():
+    board = make_board([0, 6, 5, 3])
+    walls = list(board["walls"])
+    board["walls"].append([0, 0.5])
+    board["robots"] = {}
+    assert make_board([0, 6, 5, 3]) == {"walls": walls, "goals": board["goals"]}
+
+
+def test_stream():
+    img = cv2.imread(str(DATA_PATH / "input" / "20240415_102619.jpg"))
+    board = build_board(img)
+    session_id = start_session()
+    assert read_frame(session_id, img) == (board, False)
+    assert read_frame(session_id, img) == (board, True)
+    # frame sent to a worker that never saw the session
+    assert read_frame("unseen", img) == (board, False)
+    assert read_frame("unseen", img) == (board, True)
+
+
+def test_stream_sessions(monkeypatch):
+    monkeypatch.setattr(stream, "_sessions", {})
+    monkeypatch.setattr(stream, "STREAM_MAX_SESSIONS", 3)
+    session_ids = [start_session() for _ in range(3)]
+    stream.get_session(session_ids[0])
+    # any id starts a session, the least recently seen is dropped beyond the cap
+    stream.get_session("unseen")
+    assert set(stream._sessions) == {session_ids[0], session_ids[2], "unseen"}
+    for i in range(10):
+        stream.get_session(f"unseen {i}")
+    assert len(stream._sessions) == 3
+
+
+def test_save_picture(tmp_path, monkeypatch):
+    monkeypatch.setattr(persistence, "PICTURES_PATH", tmp_path)
+    monkeypatch.setattr(persistence, "PICTURES_MAX_FILES", 2)
+    monkeypatch.setattr(persistence, "_picture_count", None)
+    data = (DATA_PATH / "input" / "20240415_102619.jpg").read_bytes()
+    for picture in (data, data, b"a", b"b"):
+        assert persistence.save_picture(picture, ".jpg")
+    persistence.flush()
+    assert len(list(tmp_path.iterdir())) == 2
+    assert not any(p.read_bytes() == data for p in tmp_path.iterdir())
+
+
 def test_clean_solution():
     for img_path, data in DATA.items():
         if "solutions" not in data:
@@ -63,6 +252,203 @@ def test_clean_solution():
         board = build_board(img)
         for robot, goal, solution in data["solutions"]:
             state = {"robots": board["robots"], "cost": 0, "prev_state": None}
-            winning_state = full_solve(board["walls"], state, robot, goal)
-            board, moves = clean_solution(board, winning_state)
+            path = full_solve(board["walls"], state, robot, goal)
+            board, moves = clean_solution(board, path)
             assert moves == solution
+
+
+def test_optimal_solve():
+    walls = [(3.5, 1), (0, 5.5)]
+    state = {"robots": {"red": (0, 0), "green": (15, 1)}, "cost": 0, "prev_state": None}
+    path = optimal_solve(walls, state, "red", (14, 0))
+    board, moves = clean_solution({}, path)
+    assert path["cost"] == 2
+    assert board["robots"] == {"red": (14, 0), "green": (15, 0)}
+    assert moves == [("red", (14, 0), (0, 0)), ("green", (15, 0), (15, 1))]
+
+
+def test_layer_solve():
+    walls = [(3.5, 1), (0, 5.5)]
+    state = {"robots": {"red": (0, 0), "green": (15, 1)}, "cost": 0, "prev_state": None}
+    path = layer_solve(walls, state, "red", (14, 0))
+    board, moves = clean_solution({}, path)
+    assert path["cost"] == 2
+    assert moves == [("red", (14, 0), (0, 0)), ("green", (15, 0), (15, 1))]
+
+    board = make_board(DATA["20240415_102619.jpg"]["quarters"])
+    state = {"robots": DATA["20240415_102619.jpg"]["robots"], "cost": 0, "prev_state": None}
+    for name, goal in list(board["goals"].items())[:6]:
+        robot = GOAL_ROBOTS.get(name[0], "red")
+        path = layer_solve(board["walls"], state, robot, goal)
+        assert path["cost"] == astar_solve(board["walls"], state, robot, goal)["cost"]
+
+
+def test_parallel_layer_solve():
+    board = make_board(DATA["20240415_102619.jpg"]["quarters"])
+    state = {"robots": DATA["20240415_102619.jpg"]["robots"], "cost": 0, "prev_state": None}
+    for name, goal in list(board["goals"].items())[:3]:
+        robot = GOAL_ROBOTS.get(name[0], "red")
+        path = parallel_layer_solve(board["walls"], state, robot, goal, processes=2)
+        assert path["cost"] == layer_solve(board["walls"], state, robot, goal)["cost"]
+
+
+def test_parallel_layer_budget(monkeypatch):
+    board = make_board(DATA["20240415_102619.jpg"]["quarters"])
+    state = {"robots": DATA["20240415_102619.jpg"]["robots"], "cost": 0, "prev_state": None}
+    expand_layer = solver.expand_layer
+
+    # the deadline passes while the workers expand a layer
+    def slow_expand_layer(stops, layer):
+        time.sleep(5)
+        return expand_layer(stops, layer)
+
+    monkeypatch.setattr(solver, "expand_layer", slow_expand_layer)
+    stats = new_stats(deadline=0.5)
+    path = parallel_layer_solve(board["walls"], state, "yellow", board["goals"]["yc"], stats=stats)
+    assert path is None and stats["status"] == "deadline exceeded"
+    assert report(stats, path)["time"] < 2
+
+    # a worker dies
+    monkeypatch.setattr(solver, "expand_layer", lambda stops, layer: os._exit(1))
+    stats = new_stats()
+    path = parallel_layer_solve(board["walls"], state, "yellow", board["goals"]["yc"], stats=stats)
+    assert path is None and stats["status"] == "worker failed"
+
+
+def test_parallel_solve():
+    board = make_board(DATA["20240415_102619.jpg"]["quarters"])
+    state = {"robots": DATA["20240415_102619.jpg"]["robots"], "cost": 0, "prev_state": None}
+    goal = board["goals"]["yc"]
+    path = parallel_solve(board["walls"], state, "yellow", goal, processes=2)
+    assert clean_solution({}, path)[0]["robots"]["yellow"] == tuple(goal)
+    # with a deadline, waits for every strategy and keeps the shortest: only moving
+    # the yellow robot takes 7 moves, the other strategies find 6
+    stats = new_stats(deadline=60)
+    path = parallel_solve(board["walls"], state, "yellow", goal, stats=stats, processes=2)
+    assert path["cost"] == astar_solve(board["walls"], state, "yellow", goal)["cost"] == 6
+
+def test_astar_solve():
+    walls = [(3.5, 1), (0, 5.5)]
+    state = {"robots": {"red": (0, 0), "green": (15, 1)}, "cost": 0, "prev_state": None}
+    for goal in [(14, 0), (3, 1), (15, 5), (3, 15)]:
+        path = astar_solve(walls, state, "red", goal)
+        assert path["cost"] == optimal_solve(walls, state, "red", goal)["cost"]
+        assert clean_solution({}, path)[0]["robots"]["red"] == goal
+
+
+def test_database_solve(tmp_path, monkeypatch):
+    board = make_board(DATA["20240415_102619.jpg"]["quarters"])
+    database.build([board], tmp_path)
+    monkeypatch.setattr(database, "_database", None)
+    database.load(tmp_path)
+    assert database.lookup(board["walls"], 8 * 16 + 5) is not None
+
+    state = {"robots": DATA["20240415_102619.jpg"]["robots"], "cost": 0, "prev_state": None}
+    for name, goal in board["goals"].items():
+        robot = GOAL_ROBOTS.get(name[0], "red")
+        path = database_solve(board["walls"], state, robot, goal)
+        assert path["cost"] == astar_solve(board["walls"], state, robot, goal)["cost"]
+
+
+
+def test_solve_budget():
+    board = make_board(DATA["20240415_102619.jpg"]["quarters"])
+    state = {"robots": DATA["20240415_102619.jpg"]["robots"], "cost": 0, "prev_state": None}
+    for mode, solver in SOLVERS.items():
+        for budget, status in (
+            ({"max_nodes": 5}, "node budget exceeded"),
+            ({"deadline": 0.05}, "deadline exceeded"),
+        ):
+            stats = new_stats(**budget)
+            path = solver(board["walls"], state, "blue", board["goals"]["bc"], stats=stats)
+            result = report(stats, path)
+            assert path is None and set(result) == {"status", "nodes", "time"}
+            assert result["time"] < 2
+            # only moving the blue robot can't reach the goal, the search ends early
+            assert result["status"] == ("unsolved" if mode == "bidirectional" else status)
+
+    # the single robot route, returned once the search for a shorter one ran out
+    stats = new_stats(max_nodes=5)
+    path = database_solve(board["walls"], state, "yellow", board["goals"]["yc"], stats=stats)
+    assert report(stats, path) == {
+        "status": "node budget exceeded",
+        "nodes": stats["nodes"],
+        "time": stats["time"],
+        "cost": 7,
+        "best_so_far": True,
+    }
+    stats = new_stats()
+    path = database_solve(board["walls"], state, "yellow", board["goals"]["yc"], stats=stats)
+    result = report(stats, path)
+    assert (result["status"], result["cost"], result["best_so_far"]) == ("solved", 6, False)
+
+    response = api.app.test_client().post(
+        "/solve",
+        json={
+            "board": board | {"robots": state["robots"]},
+            "goal": board["goals"]["bc"],
+            "robot": "blue",
+            "solver": "astar",
+            "max_nodes": 5,
+        },
+    )
+    assert response.json["msg"] == "unsolved"
+    assert response.json["stats"]["status"] == "node budget exceeded"
+
+
+def test_solution_cache(tmp_path, monkeypatch):
+    walls = [(3.5, 1), (0, 5.5)]
+    robots = {"red": (0, 0), "green": (15, 1)}
+    path = optimal_solve(walls, {"robots": robots}, "red", (14, 0))
+    rotated_walls = [solution_cache.rotate(xy, 1) for xy in walls]
+    rotated_robots = {name: solution_cache.rotate(xy, 1) for name, xy in robots.items()}
+    rotated_goal = solution_cache.rotate((14, 0), 1)
+
+    for cache_path in (None, tmp_path / "solutions.db"):
+        monkeypatch.setattr(solution_cache, "SOLUTION_CACHE_PATH", cache_path)
+        key, turns = solution_cache.solution_key(walls, robots, "red", (14, 0), "optimal")
+        solution_cache.set_solution(key, turns, path)
+        assert solution_cache.get_solution(key, turns) == path
+
+        key, turns = solution_cache.solution_key(
+            rotated_walls, rotated_robots, "red", rotated_goal, "optimal"
+        )
+        board, _ = clean_solution({}, solution_cache.get_solution(key, turns))
+        assert board["robots"] == {"red": rotated_goal, "green": solution_cache.rotate((15, 0), 1)}
+
+    # best so far paths are not cached
+    monkeypatch.setattr(solution_cache, "SOLUTION_CACHE_PATH", None)
+    monkeypatch.setattr(solution_cache, "_cache", solution_cache.OrderedDict())
+    board = make_board(DATA["20240415_102619.jpg"]["quarters"])
+    request = {
+        "board": board | {"robots": DATA["20240415_102619.jpg"]["robots"]},
+        "goal": board["goals"]["yc"],
+        "robot": "yellow",
+        "solver": "database",
+    }
+    client = api.app.test_client()
+    stats = client.post("/solve", json=request | {"max_nodes": 5}).json["stats"]
+    assert (stats["cost"], stats["best_so_far"]) == (7, True)
+    stats = client.post("/solve", json=request).json["stats"]
+    assert (stats["cost"], stats["best_so_far"]) == (6, False)
+    assert client.post("/solve", json=request | {"max_nodes": 5}).json["stats"]["cost"] == 6
+
+
+def test_solve_all_goals():
+    walls = [(3.5, 1), (0, 5.5)]
+    state = {"robots": {"red": (0, 0), "green": (15, 1)}, "cost": 0, "prev_state": None}
+    goals = {"rh": (14, 0), "gs": (15, 15), "ms": (0, 5)}
+    solutions = solve_all_goals(walls, state, goals)
+    assert solutions["rh"]["cost"] == 2
+    assert clean_solution({}, solutions["gs"])[0]["robots"]["green"] == (15, 15)
+    assert solutions["ms"]["cost"] == 1
+
+
+def test_solve_all_deadline(monkeypatch):
+    monkeypatch.setattr(api, "SOLVE_ALL_DEADLINE", 0.5)
+    board = make_board(DATA["20240415_102619.jpg"]["quarters"])
+    board["robots"] = DATA["20240415_102619.jpg"]["robots"]
+    response = api.app.test_client().post("/solve_all", json={"board": board})
+    assert response.json["stats"]["status"] == "deadline exceeded"
+    assert response.json["stats"]["time"] < 2
+    assert response.json["solutions"]["ys"] is not None